@@ -0,0 +1,187 @@
+"""
+Benchmark Amazon, Goodreads and Scraper end to end against the local
+stand-in server (see standin.py), reporting requests per second, p50 and
+p99 latency and memory for each client under each workload:
+
+    sequential  one call after another
+    threaded    the same calls from a pool of threads
+    cached      calls answered from a warm LRUCache
+
+    python benchmarks/bench_clients.py [-n NUMBER] [--threads THREADS]
+                                       [--save FILE] [--baseline FILE] ...
+
+--save writes the results as JSON; --baseline compares against such a
+file and exits with status 1 if any result got slower by more than
+--tolerance, so this can guard against performance regressions.
+"""
+import argparse
+import json
+import resource
+import ssl
+import sys
+import time
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+
+import standin
+
+from bottlenose.amazon import Amazon
+from bottlenose.cache import LRUCache
+from bottlenose.goodreads import Goodreads
+from bottlenose.scraper import Scraper
+
+
+WORKLOADS = ("sequential", "threaded", "cached")
+
+
+def make_clients(base_url, ssl_context, cache=None):
+    """Each client, and a function making its ith call."""
+    def transport():
+        return standin.LocalTransport(base_url, ssl_context=ssl_context)
+
+    # coalescing would hide the cost of the calls being measured
+    amazon = Amazon(standin.ACCESS_KEY, standin.SECRET_KEY, standin.ASSOCIATE_TAG,
+                    transport=transport(), cache=cache, single_flight=False)
+    goodreads = Goodreads(standin.GOODREADS_KEY, transport=transport(),
+                          cache=cache, single_flight=False)
+    scraper = Scraper(transport=transport(), cache=cache, single_flight=False)
+
+    return [
+        ("amazon", lambda i: amazon.ItemLookup(
+            ItemId="B%09d" % i, ResponseGroup="Large")),
+        ("goodreads", lambda i: goodreads.search(q="book %d" % i)),
+        ("scraper", lambda i: scraper.get(url="https://example.com/page/%d" % i)),
+    ]
+
+
+def run(call, count, threads):
+    """Make count calls; returns each call's latency and the errors."""
+    latencies = []
+    errors = []
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            call(i)
+        except Exception as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - start)
+
+    if threads:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(timed, range(count)))
+    else:
+        for i in range(count):
+            timed(i)
+    return latencies, errors
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def measure(call, count, threads, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    latencies, errors = run(call, count, threads)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'rps': count / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'errors': len(errors),
+        'peak_mb': peak / 2 ** 20 if peak is not None else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Describe each result that's more than tolerance worse than baseline."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        before = baseline.get(key)
+        if not before:
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append("%s: %.0f req/s, was %.0f" %
+                               (key, result['rps'], before['rps']))
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append("%s: p99 %.2f ms, was %.2f" %
+                               (key, result['p99_ms'], before['p99_ms']))
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("-n", "--number", type=int, default=1000,
+                            help="calls per client per workload")
+    arg_parser.add_argument("--threads", type=int, default=8,
+                            help="threads for the threaded workload")
+    arg_parser.add_argument("--workload", choices=WORKLOADS, action="append",
+                            help="run only this workload (may be repeated)")
+    arg_parser.add_argument("--trace-memory", action="store_true",
+                            help="report peak traced memory (slows the run)")
+    arg_parser.add_argument("--save", help="write the results to this JSON file")
+    arg_parser.add_argument("--baseline", help="compare with this JSON file")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="allowed slowdown against --baseline")
+    standin.add_arguments(arg_parser)
+    options = arg_parser.parse_args()
+    options.port = 0
+
+    _, base_url = standin.start(options)
+    ssl_context = None
+    if options.certfile:
+        # the stand-in's certificate is for 127.0.0.1, not the API hosts
+        ssl_context = ssl.create_default_context(cafile=options.certfile)
+        ssl_context.check_hostname = False
+
+    print("%-10s %-10s %9s %9s %9s %7s %8s" %
+          ("client", "workload", "req/s", "p50 ms", "p99 ms", "errors", "peak MB"))
+
+    results = {}
+    for workload in options.workload or WORKLOADS:
+        cache = LRUCache(max_entries=options.number) if workload == "cached" else None
+        threads = options.threads if workload == "threaded" else 0
+
+        for name, call in make_clients(base_url, ssl_context, cache):
+            if workload == "cached":
+                run(call, options.number, 0)
+            else:
+                # open connections before timing anything
+                run(call, max(1, threads), threads)
+
+            result = measure(call, options.number, threads, options.trace_memory)
+            results["%s/%s" % (name, workload)] = result
+            print("%-10s %-10s %9.0f %9.2f %9.2f %7d %8s" % (
+                name, workload, result['rps'], result['p50_ms'], result['p99_ms'],
+                result['errors'],
+                "%.1f" % result['peak_mb'] if result['peak_mb'] is not None else "-"))
+
+    print("max RSS %.1f MB" %
+          (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
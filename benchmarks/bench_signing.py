@@ -0,0 +1,120 @@
+"""
+Benchmark AmazonCall.api_url against the original from-scratch signing
+code, after checking that both produce byte-identical URLs.
+
+    python benchmarks/bench_signing.py [-n NUMBER]
+"""
+import argparse
+import hmac
+import random
+import string
+import time
+import timeit
+
+from base64 import b64encode
+from hashlib import sha256
+from urllib import parse
+
+from bottlenose.amazon import SERVICE_DOMAINS, AmazonCall
+from bottlenose.api import quote_query
+
+
+def legacy_api_url(call, **kwargs):
+    """AmazonCall.api_url as it was before RequestSigner."""
+    query = {
+        'Operation': call.operation,
+        'Service': "AWSECommerceService",
+        'Timestamp': time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'Version': call.version,
+    }
+    query.update(kwargs)
+
+    query['AWSAccessKeyId'] = call.aws_access_key_id
+    query['Timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                       time.gmtime())
+
+    if call.associate_tag:
+        query['AssociateTag'] = call.associate_tag
+
+    service_domain = SERVICE_DOMAINS[call.region][0]
+    quoted_strings = quote_query(query)
+
+    data = "GET\n" + service_domain + "\n/onca/xml\n" + quoted_strings
+
+    secret = call.aws_secret_access_key
+    if type(secret) is str:
+        secret = secret.encode('utf-8')
+
+    digest = hmac.new(secret, data.encode('utf-8'), sha256).digest()
+    signature = parse.quote(b64encode(digest))
+
+    return ("https://" + service_domain + "/onca/xml?" +
+            quoted_strings + "&Signature=%s" % signature)
+
+
+def random_query(rng):
+    alphabet = string.ascii_letters + string.digits + " ,+/=&~-_.:é"
+    query = {
+        'ItemId': ",".join(
+            "".join(rng.choice(string.ascii_uppercase + string.digits)
+                    for _ in range(10))
+            for _ in range(rng.randint(1, 10))),
+        'ResponseGroup': rng.choice(["Large", "Images,ItemAttributes", "Offers"]),
+    }
+    for _ in range(rng.randint(0, 3)):
+        key = rng.choice(["Keywords", "SearchIndex", "IdType", "Condition",
+                          "Service", "Version", "Timestamp", "AssociateTag"])
+        query[key] = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 20)))
+    return query
+
+
+def check_identical(calls, count):
+    rng = random.Random(0)
+    for i in range(count):
+        call = calls[i % len(calls)]
+        query = random_query(rng)
+        expected = legacy_api_url(call, **query)
+        actual = call.api_url(**query)
+        if actual != expected:
+            raise AssertionError("signatures differ for %r:\n%s\n%s" %
+                                 (query, expected, actual))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("-n", "--number", type=int, default=20000,
+                            help="signatures per timing run")
+    args = arg_parser.parse_args()
+
+    calls = [
+        AmazonCall("AKIAEXAMPLE", "secret/key+with=chars", "tag-20",
+                   region="US", operation="ItemLookup"),
+        AmazonCall("AKIAEXAMPLE", "secret", None, region="UK",
+                   operation="ItemSearch"),
+        AmazonCall("AKIA2", "sécret", "tag-21", region="JP",
+                   operation="BrowseNodeLookup"),
+    ]
+
+    # the timestamp changes from second to second, so freeze the clock
+    # while comparing signatures
+    real_time, real_gmtime = time.time, time.gmtime
+    frozen = real_time()
+    time.time = lambda: frozen
+    time.gmtime = lambda secs=None: real_gmtime(frozen if secs is None else secs)
+    try:
+        check_identical(calls, 5000)
+    finally:
+        time.time, time.gmtime = real_time, real_gmtime
+    print("signatures identical for 5000 random queries")
+
+    call = calls[0]
+    query = {'ItemId': "B00EXAMPLE", 'ResponseGroup': "Large"}
+    for name, fn in [("legacy", lambda: legacy_api_url(call, **query)),
+                     ("api_url", lambda: call.api_url(**query))]:
+        best = min(timeit.repeat(fn, number=args.number, repeat=5))
+        print("%-8s %6.2f us/call" % (name, best / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+A local stand-in for the services bottlenose talks to, for benchmarking
+without the network or an API key:
+
+    /onca/xml               Amazon Product Advertising API. Checks the
+                            request signature and answers ItemLookup and
+                            ItemSearch with generated items.
+    /<operation>/index.xml  Goodreads API. Checks the key and answers with
+                            generated books.
+    anything else           A generated HTML page, for Scraper.
+
+Bodies are gzipped when the client accepts it. Every response can be
+delayed by a fixed latency, and Amazon calls beyond a query rate are
+answered with 503 RequestThrottled, like the real thing.
+
+    python benchmarks/standin.py [--port PORT] [--latency SECONDS] ...
+
+Clients reach it through LocalTransport, which sends requests for any
+host to the stand-in instead.
+"""
+import argparse
+import collections
+import gzip
+import hmac
+import multiprocessing
+import ssl
+import threading
+import time
+
+from base64 import b64encode
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+from bottlenose.transport import PooledTransport
+
+
+ACCESS_KEY = "AKIABENCHMARK"
+SECRET_KEY = "benchmark/secret+key="
+ASSOCIATE_TAG = "bench-20"
+GOODREADS_KEY = "benchmark-key"
+SERVICE_DOMAIN = "webservices.amazon.com"
+
+ITEM = ("<Item><ASIN>%(asin)s</ASIN><DetailPageURL>https://www.amazon.com/dp/"
+        "%(asin)s</DetailPageURL><ItemAttributes><Title>Item %(asin)s</Title>"
+        "<Author>Author %(asin)s</Author><ProductGroup>Book</ProductGroup>"
+        "</ItemAttributes><SalesRank>%(rank)d</SalesRank></Item>")
+
+BOOK = ("<book><id>%(id)d</id><title>Book %(id)d</title><isbn>%(isbn)s</isbn>"
+        "<average_rating>3.9</average_rating><authors><author><name>Author "
+        "%(id)d</name></author></authors></book>")
+
+
+def amazon_error(code, message):
+    return ('<?xml version="1.0"?><ItemLookupErrorResponse xmlns="http://'
+            'ecs.amazonaws.com/doc/2013-08-01/"><Error><Code>%s</Code>'
+            '<Message>%s</Message></Error></ItemLookupErrorResponse>' %
+            (code, message)).encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; don't let Nagle's
+    # algorithm hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        options = self.server.options
+        if options.latency:
+            time.sleep(options.latency)
+
+        parts = parse.urlsplit(self.path)
+        if parts.path == "/onca/xml":
+            status, body = self.amazon(parts.query)
+        elif parts.path.endswith("/index.xml"):
+            status, body = self.goodreads(parts.path[1:-len("/index.xml")],
+                                          parse.parse_qs(parts.query))
+        else:
+            status, body = 200, self.page(parts.path)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=UTF-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, options.compress_level)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def amazon(self, query_string):
+        # the signature covers the query exactly as sent, minus itself
+        unsigned, _, signature = query_string.rpartition("&Signature=")
+        data = "GET\n%s\n/onca/xml\n%s" % (SERVICE_DOMAIN, unsigned)
+        expected = b64encode(hmac.new(SECRET_KEY.encode('utf-8'),
+                                      data.encode('utf-8'), sha256).digest())
+        if not hmac.compare_digest(parse.unquote(signature).encode('utf-8'), expected):
+            return 403, amazon_error("SignatureDoesNotMatch",
+                                     "The request signature does not match.")
+
+        if self.server.throttled():
+            return 503, amazon_error("RequestThrottled",
+                                     "You are submitting requests too quickly.")
+
+        query = dict(parse.parse_qsl(unsigned))
+        operation = query.get("Operation")
+        if operation == "ItemLookup":
+            asins = query.get("ItemId", "").split(",")
+        elif operation == "ItemSearch":
+            page = int(query.get("ItemPage", 1))
+            asins = ["S%09d" % (page * 10 + i) for i in range(10)]
+        else:
+            return 400, amazon_error("AWS.InvalidOperationParameter",
+                                     "%s is not a valid operation." % operation)
+
+        items = "".join(ITEM % {'asin': asin, 'rank': i + 1}
+                        for i, asin in enumerate(asins))
+        return 200, (
+            '<?xml version="1.0"?><%sResponse xmlns="http://webservices.'
+            'amazon.com/AWSECommerceService/2013-08-01"><Items><Request>'
+            '<IsValid>True</IsValid></Request><TotalResults>100</TotalResults>'
+            '<TotalPages>10</TotalPages>%s</Items></%sResponse>' %
+            (operation, items, operation)).encode('utf-8')
+
+    def goodreads(self, operation, query):
+        if query.get("key") != [GOODREADS_KEY]:
+            return 401, b"Invalid API key."
+
+        count = self.server.options.items
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * count + 1
+        books = "".join(BOOK % {'id': i, 'isbn': "%010d" % i}
+                        for i in range(start, start + count))
+        return 200, (
+            '<?xml version="1.0" encoding="UTF-8"?><GoodreadsResponse>'
+            '<Request><method>%s</method></Request><books start="%d" end="%d" '
+            'total="%d">%s</books></GoodreadsResponse>' %
+            (operation, start, start + count - 1, count * 10, books)).encode('utf-8')
+
+    def page(self, path):
+        paragraph = "<p>%s</p>" % ("Lorem ipsum dolor sit amet. " * 20)
+        return ("<!DOCTYPE html><html><head><title>%s</title></head><body>%s"
+                "</body></html>" % (path, paragraph * self.server.options.items)
+                ).encode('utf-8')
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, address, options):
+        ThreadingHTTPServer.__init__(self, address, StandInHandler)
+        self.options = options
+
+        self._recent = collections.deque()
+        self._lock = threading.Lock()
+
+        if options.certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(options.certfile, options.keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def throttled(self):
+        """Whether an Amazon call now would exceed throttle_qps."""
+        if not self.options.throttle_qps:
+            return False
+
+        now = time.time()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.options.throttle_qps:
+                return True
+            self._recent.append(now)
+        return False
+
+
+class LocalTransport(PooledTransport):
+    """A PooledTransport that sends every request to the stand-in."""
+    def __init__(self, base_url, **kwargs):
+        super(LocalTransport, self).__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def open(self, url, headers, timeout=None):
+        parts = parse.urlsplit(url)
+        local_url = self.base_url + parts.path
+        if parts.query:
+            local_url += "?" + parts.query
+        return super(LocalTransport, self).open(local_url, headers, timeout)
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument("--latency", type=float, default=0.0,
+                            help="seconds to delay every response")
+    arg_parser.add_argument("--throttle-qps", type=float, default=None,
+                            help="answer Amazon calls beyond this rate with 503")
+    arg_parser.add_argument("--items", type=int, default=20,
+                            help="books per Goodreads page and paragraphs per page")
+    arg_parser.add_argument("--compress-level", type=int, default=6,
+                            help="gzip level for response bodies")
+    arg_parser.add_argument("--certfile", default=None,
+                            help="serve HTTPS with this certificate")
+    arg_parser.add_argument("--keyfile", default=None,
+                            help="private key for --certfile")
+
+
+def _serve(options, port_pipe):
+    server = StandInServer(("127.0.0.1", options.port), options)
+    port_pipe.send(server.server_address[1])
+    port_pipe.close()
+    server.serve_forever()
+
+
+def start(options):
+    """
+    Run the stand-in in a separate process, so it doesn't compete with the
+    benchmark for the GIL. Returns the process and the base URL.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_serve, args=(options, sender),
+                                      daemon=True)
+    process.start()
+    port = receiver.recv()
+    scheme = "https" if options.certfile else "http"
+    return process, "%s://127.0.0.1:%d" % (scheme, port)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--port", type=int, default=8000)
+    add_arguments(arg_parser)
+    options = arg_parser.parse_args()
+
+    server = StandInServer(("127.0.0.1", options.port), options)
+    print("serving on port %d" % server.server_address[1])
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
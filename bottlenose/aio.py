@@ -0,0 +1,626 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import inspect
+import io
+import logging
+import socket
+import ssl
+import sys
+import time
+
+from email.parser import BytesParser
+from http.client import HTTPMessage
+from urllib import parse
+from urllib.error import HTTPError, URLError
+
+from bottlenose.api import Call, _own_error, random_desktop_user_agent
+from bottlenose.metrics import error_name
+from bottlenose.retry import DeadlineExceeded, time_left
+from bottlenose.stream import iterparse_elements
+
+
+log = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+async def maybe_await(value):
+    """Await value if it is awaitable, so hooks can be sync or async."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncResponse(object):
+    """
+    A fully read HTTP response, shaped like the object urlopen() returns.
+    """
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+        self._offset = 0
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        start = self._offset
+        self._offset = len(self.body) if amt is None else min(len(self.body), start + amt)
+        return self.body[start:self._offset]
+
+    def close(self):
+        pass
+
+
+async def _read_body(reader, status, headers):
+    """
+    Read a response body. Returns the body and whether its end was
+    delimited, i.e. whether the connection can carry another request.
+    """
+    if status in (204, 304) or 100 <= status < 200:
+        return b'', True
+
+    if 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+        chunks = []
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # skip any trailers up to the final blank line
+                while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                    pass
+                return b''.join(chunks), True
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    content_length = headers.get('Content-Length')
+    if content_length is not None:
+        return await reader.readexactly(int(content_length)), True
+
+    return await reader.read(), False
+
+
+class AsyncTransport(object):
+    """
+    Makes requests on the running event loop, keeping connections open
+    between requests to the same host.
+
+    pool_size: maximum number of idle connections kept per host.
+    idle_timeout: seconds an idle connection is kept before being closed.
+    ssl_context: optional ssl.SSLContext for HTTPS connections.
+    """
+    def __init__(self, pool_size=10, idle_timeout=60, ssl_context=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+
+        self._idle = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_idle']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._idle = {}
+
+    def _checkout(self, key):
+        """Return an idle (reader, writer) pair for key, or None."""
+        loop = asyncio.get_event_loop()
+        now = time.time()
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer, connection_loop, last_used = idle.pop()
+            # connections can't be shared between event loops
+            if (connection_loop is loop and not reader.at_eof() and
+                    now - last_used < self.idle_timeout):
+                return reader, writer
+            writer.close()
+        return None
+
+    def _checkin(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append((reader, writer, asyncio.get_event_loop(), time.time()))
+        else:
+            writer.close()
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            ssl_context = self.ssl_context or ssl.create_default_context()
+        else:
+            ssl_context = None
+        return await asyncio.open_connection(host, port, ssl=ssl_context)
+
+    async def _fetch(self, url, headers):
+        parts = parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('unknown url type: %s' % parts.scheme)
+
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc]
+        lines.extend('%s: %s' % item for item in headers.items())
+        request_bytes = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        connection = self._checkout(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = await self._connect(key)
+            reader, writer = connection
+            try:
+                writer.write(request_bytes)
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+                if not reused:
+                    raise
+                # the server dropped an idle connection; retry on a new one
+                log.debug("Reconnecting to %s" % parts.netloc)
+                connection, reused = None, False
+                continue
+            except:
+                writer.close()
+                raise
+            break
+
+        try:
+            status_line, _, header_block = head.partition(b'\r\n')
+            version, status, reason = (
+                status_line.decode('latin-1').split(' ', 2) + [''])[:3]
+            status = int(status)
+            message = BytesParser(_class=HTTPMessage).parsebytes(header_block)
+
+            body, delimited = await _read_body(reader, status, message)
+        except:
+            writer.close()
+            raise
+
+        connection_header = (message.get('Connection') or '').lower()
+        if delimited and version == 'HTTP/1.1' and 'close' not in connection_header:
+            self._checkin(key, reader, writer)
+        else:
+            writer.close()
+
+        return AsyncResponse(url, status, reason, message, body)
+
+    async def open(self, url, headers, timeout=None):
+        """
+        GET url, following redirects. Like urlopen(), raises HTTPError for
+        error statuses and URLError when the host can't be reached.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            try:
+                response = await asyncio.wait_for(
+                    self._fetch(url, headers), timeout)
+            except asyncio.TimeoutError:
+                raise URLError(socket.timeout('timed out'))
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                raise URLError(e)
+
+            location = response.headers.get('Location')
+            if response.status in REDIRECT_CODES and location:
+                url = parse.urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, io.BytesIO(response.body))
+
+            return response
+
+        raise HTTPError(url, response.status, "Too many redirects",
+                        response.headers, io.BytesIO(response.body))
+
+    def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer, _, _ in connections:
+                writer.close()
+
+
+class AsyncCall(Call):
+    """
+    A Call whose requests are coroutines, so many can be in flight at once
+    on a single event loop.
+
+    cache_reader, cache_writer, parser and error_handler may be plain
+    functions or coroutine functions. transport must be an AsyncTransport
+    or another object with a coroutine open(url, headers, timeout) method.
+    """
+    def _default_transport(self):
+        return AsyncTransport()
+
+    def _default_single_flight(self):
+        return AsyncSingleFlight()
+
+    async def _throttle(self, operation):
+        if not self.rate_limiter:
+            return
+
+        if self.metrics:
+            start = time.perf_counter()
+        reserve_async = getattr(self.rate_limiter, 'reserve_async', None)
+        if not reserve_async:
+            # tokens are reserved before sleeping, so concurrent coroutines
+            # queue up behind each other instead of all waking at once
+            wait_time = self._reserve()
+        else:
+            # a PriorityScheduler, which waits for our turn in reserve_async()
+            left = time_left()
+            if left is None:
+                wait_time = await reserve_async()
+            else:
+                wait_time = await reserve_async(max_wait=left)
+                if wait_time > left:
+                    raise DeadlineExceeded(
+                        "Rate limit wait would pass the deadline, %.3fs away" % left)
+        if wait_time > 0:
+            log.debug('Waiting %.3fs to call API' % wait_time)
+            await asyncio.sleep(wait_time)
+        if self.metrics:
+            self.metrics.observe(operation, 'throttle', time.perf_counter() - start)
+
+    async def _parse(self, operation, response_text, cache_url=None):
+        if not (self.metrics and self.parser):
+            result = await maybe_await(self._maybe_parse(response_text))
+        else:
+            start = time.perf_counter()
+            result = await maybe_await(self._maybe_parse(response_text))
+            self.metrics.observe(operation, 'parse', time.perf_counter() - start)
+
+        if cache_url is not None and self._caches_parsed():
+            self._cache_parsed(cache_url, result)
+        return result
+
+    async def _read_cache(self, operation, cache_url, kwargs=None):
+        if not self.cache_reader:
+            return None
+        if not self.metrics:
+            return await self._cached_response_text(operation, cache_url, kwargs)
+
+        start = time.perf_counter()
+        cached_response_text = await self._cached_response_text(
+            operation, cache_url, kwargs)
+        self.metrics.observe(operation, 'cache', time.perf_counter() - start)
+        self.metrics.increment(
+            operation, 'cache_miss' if cached_response_text is None else 'cache_hit')
+        return cached_response_text
+
+    async def _cached_response_text(self, operation, cache_url, kwargs):
+        if self._reads_entries():
+            # the caches in bottlenose.cache aren't awaitable
+            return super(AsyncCall, self)._cached_response_text(
+                operation, cache_url, kwargs)
+        return await maybe_await(self.cache_reader(cache_url))
+
+    def _refresh_in_background(self, operation, cache_url, kwargs):
+        with self._refresh_lock:
+            if cache_url in self._refreshing:
+                return
+            # in a context of its own, so the caller's deadline and priority
+            # don't carry over
+            self._refreshing[cache_url] = contextvars.Context().run(
+                asyncio.ensure_future, self._refresh(operation, cache_url, kwargs))
+
+    async def _refresh(self, operation, cache_url, kwargs):
+        try:
+            if self.single_flight:
+                await self.single_flight.do(
+                    cache_url, lambda: self._request(operation, cache_url, kwargs))
+            else:
+                await self._request(operation, cache_url, kwargs)
+        except Exception as e:
+            log.debug("Couldn't refresh %s: %r" % (cache_url, e))
+        finally:
+            with self._refresh_lock:
+                del self._refreshing[cache_url]
+
+    async def _write_cache(self, operation, cache_url, response_text,
+                           etag=None, last_modified=None):
+        if not self.cache_writer:
+            return
+
+        cache_writer = self.cache_writer
+        if (etag or last_modified) and self._keeps_entries():
+            cache_writer = functools.partial(self.cache.set, etag=etag,
+                                             last_modified=last_modified)
+
+        if not self.metrics:
+            await maybe_await(cache_writer(cache_url, response_text))
+            return
+
+        start = time.perf_counter()
+        await maybe_await(cache_writer(cache_url, response_text))
+        self.metrics.observe(operation, 'cache_write', time.perf_counter() - start)
+
+    async def _call_api(self, api_url, err_env, extra_headers=None):
+        """
+        urlopen(), plus error handling and possible retries.
+
+        err_env is a dict of additional info passed to the error handler
+        """
+        attempt = 0
+        while True:  # may retry on error
+            attempt += 1
+            headers = {"Accept-Encoding": "gzip",
+                       "User-Agent": random_desktop_user_agent()}
+            if extra_headers:
+                headers.update(extra_headers)
+
+            log.debug("API URL: %s" % api_url)
+
+            # see Call._call_api()
+            timeout = self._attempt_timeout()
+
+            if self.retry_policy:
+                self.retry_policy.check(api_url)
+
+            try:
+                response = await self.transport.open(api_url, headers,
+                                                     timeout=timeout)
+            except Exception:
+                exception = sys.exc_info()[1]
+                self._record_outcome(exception)
+                if self.metrics:
+                    self.metrics.increment(err_env.get('operation'),
+                                           error_name(exception))
+                err = {'exception': exception}
+                err.update(err_env)
+
+                if self.retry_policy:
+                    retry_delay = self.retry_policy.record_failure(
+                        api_url, attempt, exception)
+                    if self.error_handler:
+                        err['retry_delay'] = retry_delay
+                        await maybe_await(self.error_handler(err))
+                    if retry_delay is None:
+                        raise
+                    self._check_retry_delay(retry_delay)
+                    log.debug('Retrying in %.3fs after %r' % (retry_delay, exception))
+                    await asyncio.sleep(retry_delay)
+                elif not self.error_handler or attempt > self.max_retries:
+                    raise
+                elif not await maybe_await(self.error_handler(err)):
+                    raise
+
+                if self.metrics:
+                    self.metrics.increment(err_env.get('operation'), 'retries')
+            else:
+                self._record_outcome()
+                if self.retry_policy:
+                    self.retry_policy.record_success(api_url)
+                return response
+
+    async def _open(self, operation, cache_url, kwargs, extra_headers=None):
+        """
+        Throttle and call the API, bypassing the cache. Returns the
+        response, which the transport has already read in full.
+        """
+        # throttle before signing, so a long wait can't expire the timestamp
+        await self._throttle(operation)
+
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        api_url = self._api_url(operation, kwargs)
+        if metrics:
+            metrics.observe(operation, 'sign', time.perf_counter() - start)
+
+        # make the actual API call; the transport reads the whole body, so
+        # network includes the download
+        err_env = {'operation': operation, 'api_url': api_url, 'cache_url': cache_url}
+        if metrics:
+            start = time.perf_counter()
+        response = await self._call_api(api_url, err_env, extra_headers)
+        if metrics:
+            metrics.observe(operation, 'network', time.perf_counter() - start)
+        return response
+
+    def _read(self, response):
+        # the transport read the body within the request's timeout
+        return response.read()
+
+    def _decode(self, operation, response):
+        if self.metrics:
+            # the body was read along with the headers, so there's no
+            # download to time
+            return self._decode_timed(operation, response, response.read())
+        return super(AsyncCall, self)._decode(operation, response)
+
+    async def _fetch(self, operation, cache_url, kwargs):
+        """
+        Throttle, call the API and return the decompressed response,
+        bypassing the cache.
+        """
+        return self._decode(operation, await self._open(operation, cache_url, kwargs))
+
+    async def _fetch_and_store(self, operation, cache_url, kwargs):
+        """See Call._fetch_and_store()."""
+        stale_entry = self._stale_entry(cache_url)
+        extra_headers = stale_entry.revalidation_headers() if stale_entry else None
+
+        try:
+            response = await self._open(operation, cache_url, kwargs, extra_headers)
+        except HTTPError as e:
+            raise self._negative_cache(operation, cache_url, e)
+        response_text, etag, last_modified = self._revalidated(
+            operation, cache_url, response, self._decode(operation, response),
+            stale_entry)
+
+        await self._write_cache(operation, cache_url, response_text, etag, last_modified)
+        return response_text
+
+    async def _with_call_options(self, options, fn, *args):
+        # set in the awaiting task's context, as the coroutine runs there
+        if not options and self.deadline is None:
+            return await fn(*args)
+
+        tokens = self._set_call_options(options)
+        try:
+            return await fn(*args)
+        finally:
+            self._reset_call_options(tokens)
+
+    async def _call(self, operation, kwargs):
+        cache_url = self._cache_url(operation, kwargs)
+
+        parsed_entry = self._read_parsed(operation, cache_url)
+        if parsed_entry is not None:
+            return parsed_entry.data
+
+        cached_response_text = await self._read_cache(operation, cache_url, kwargs)
+        if cached_response_text is not None:
+            return await self._parse(operation, cached_response_text, cache_url)
+
+        if self.single_flight:
+            return await self.single_flight.do(
+                cache_url, lambda: self._request(operation, cache_url, kwargs))
+        return await self._request(operation, cache_url, kwargs)
+
+    async def _request(self, operation, cache_url, kwargs):
+        # fetch it and write it back to the cache
+        response_text = await self._fetch_and_store(operation, cache_url, kwargs)
+
+        # parse and return it
+        return await self._parse(operation, response_text, cache_url)
+
+    async def _call_text(self, operation, kwargs):
+        """Like _call(), but returns the unparsed response."""
+        cache_url = self._cache_url(operation, kwargs)
+
+        cached_response_text = await self._read_cache(operation, cache_url, kwargs)
+        if cached_response_text is not None:
+            return cached_response_text
+
+        return await self._fetch_and_store(operation, cache_url, kwargs)
+
+    async def _pages(self, operation, max_pages, prefetch, kwargs):
+        """
+        Make the call and asynchronously yield the (parsed) response for
+        each page of results, with up to prefetch of the following pages
+        being fetched as tasks meanwhile.
+        """
+        if not self.page_param:
+            raise ValueError("%s results can't be paged" % self.__class__.__name__)
+
+        # each page is a call of its own, with its own deadline
+        kwargs, options = self._split_call_options(kwargs)
+        first_response_text = await self._with_call_options(
+            options, self._call_text, operation, kwargs)
+        queries = collections.deque(
+            self._page_queries(first_response_text, kwargs, max_pages))
+
+        yield await self._parse(operation, first_response_text)
+
+        prefetch = max(1, prefetch)
+        fetching = collections.deque()
+        try:
+            while queries or fetching:
+                while queries and len(fetching) < prefetch:
+                    fetching.append(asyncio.ensure_future(
+                        self._with_call_options(options, self._call, operation,
+                                                queries.popleft())))
+                yield await fetching.popleft()
+        finally:
+            for task in fetching:
+                task.cancel()
+
+    async def _iter_elements(self, operation, tags, kwargs):
+        """
+        Make the call and asynchronously yield the XML elements named in
+        tags (by default stream_tags) one at a time, freeing each once the
+        next one is requested. The body itself is read in full before
+        parsing starts. Elements are ElementTree elements; parser is not
+        applied, and the response isn't written to the cache.
+        """
+        tags = tags or self.stream_tags
+        if not tags:
+            raise ValueError("No tags given to iterate over")
+
+        kwargs, options = self._split_call_options(kwargs)
+        cache_url = self._cache_url(operation, kwargs)
+
+        response_text = await self._read_cache(operation, cache_url)
+        if response_text is None:
+            response_text = await self._with_call_options(
+                options, self._fetch, operation, cache_url, kwargs)
+
+        for element in iterparse_elements(io.BytesIO(response_text), tags):
+            yield element
+
+
+class AsyncSingleFlight(object):
+    """
+    Coalesces concurrent coroutines with the same key, so only the first
+    one does the work and everyone waiting on it gets its result or
+    exception.
+    """
+    def __init__(self):
+        self._calls = {}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    async def do(self, key, fn):
+        """Return await fn(), or the result of the fn() already running for key."""
+        call = self._calls.get(key)
+        if call is not None:
+            # shield, so one waiter being cancelled (or giving up at its
+            # deadline) doesn't cancel the rest; the call keeps to the
+            # first caller's deadline
+            try:
+                return await asyncio.wait_for(asyncio.shield(call), time_left())
+            except asyncio.TimeoutError:
+                if call.done():
+                    raise
+                raise DeadlineExceeded("Deadline passed waiting for the same call")
+            except HTTPError as e:
+                raise _own_error(e).with_traceback(e.__traceback__) from None
+
+        call = self._calls[key] = asyncio.ensure_future(self._buffered(fn))
+        call.add_done_callback(lambda _: self._forget(key, call))
+        try:
+            return await asyncio.shield(call)
+        except HTTPError as e:
+            raise _own_error(e).with_traceback(e.__traceback__) from None
+
+    @staticmethod
+    async def _buffered(fn):
+        # everyone gets their own copy of an HTTPError, so reading one
+        # doesn't leave the others an empty body
+        try:
+            return await fn()
+        except HTTPError as e:
+            raise _own_error(e).with_traceback(e.__traceback__) from None
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+__all__ = ["AsyncCall", "AsyncResponse", "AsyncSingleFlight", "AsyncTransport"]
@@ -1,13 +1,22 @@
+import contextvars
+import copy
+import functools
 import hmac
 import os
+import re
+import threading
 import time
 
 from base64 import b64encode
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import sha256
 from urllib import parse
+from urllib.error import HTTPError
 
 from bottlenose import Call
-from bottlenose.api import quote_query
+from bottlenose.aio import AsyncCall
+from bottlenose.api import Operation, quote_query
 
 
 SERVICE_DOMAINS = {
@@ -26,23 +35,158 @@ SERVICE_DOMAINS = {
 }
 
 
+ITEM_TAG = re.compile(br'<(/?)Item[\s>]')
+ASIN_TAG = re.compile(br'<ASIN>\s*([^<\s]+)\s*</ASIN>')
+TOTAL_PAGES_TAG = re.compile(br'<TotalPages>\s*(\d+)\s*</TotalPages>')
+ERROR_CODE_TAG = re.compile(br'<Code>\s*([^<\s]+)\s*</Code>')
+ERRORS_TAG = re.compile(br'<Errors>.*?</Errors>', re.DOTALL)
+# the ItemIds a response echoes from its request
+ITEM_ID_TAGS = re.compile(br'<ItemId>[^<]*</ItemId>(?:\s*<ItemId>[^<]*</ItemId>)*')
+ITEM_ID_ARGUMENT = re.compile(br'(<Argument\s+Name="ItemId"\s+Value=")[^"]*(")')
+
+# errors (sent with a 400) about the query itself, which asking again won't
+# fix; unlike e.g. RequestExpired or a problem with the credentials
+PERMANENT_ERRORS = frozenset([
+    b'AWS.InvalidEnumeratedParameter',
+    b'AWS.InvalidParameterCombination',
+    b'AWS.InvalidParameterValue',
+    b'AWS.MissingParameters',
+    b'AWS.ParameterOutOfRange',
+    b'AWS.RestrictedParameterValueCombination',
+])
+
+# Amazon's limit on comma-separated ItemIds in one ItemLookup
+MAX_ITEM_IDS = 10
+
+# the order of a credential tuple passed to AmazonPool
+CREDENTIAL_KEYS = ('aws_access_key_id', 'aws_secret_access_key', 'associate_tag')
+
+
 class AmazonError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=4096)
+def _quote_param(key, value):
+    # one "key=value" term of quote_query()
+    return "%s=%s" % (key, parse.quote(value.encode('utf-8'), safe='~'))
+
+
+class RequestSigner(object):
+    """
+    Signs Product Advertising API requests for one set of credentials,
+    region and API version.
+
+    Everything that doesn't depend on the query is done once: the HMAC is
+    keyed and fed the canonical request prefix up front, the terms for
+    the credentials and each operation are quoted once, and the timestamp
+    is formatted at most once a second. Signatures are identical to
+    signing the whole request from scratch.
+    """
+    def __init__(self, aws_access_key_id, aws_secret_access_key,
+                 associate_tag, service_domain, version):
+        secret = aws_secret_access_key
+        if type(secret) is str:
+            secret = secret.encode('utf-8')
+
+        self._hmac = hmac.new(
+            secret, ("GET\n" + service_domain + "\n/onca/xml\n").encode('utf-8'),
+            sha256)
+        self._url_prefix = "https://" + service_domain + "/onca/xml?"
+        self._version = version
+
+        # these override any value passed in the query
+        self._overrides = {
+            'AWSAccessKeyId': _quote_param('AWSAccessKeyId', str(aws_access_key_id)),
+        }
+        if associate_tag:
+            self._overrides['AssociateTag'] = _quote_param(
+                'AssociateTag', str(associate_tag))
+
+        self._defaults = {}
+        self._timestamp = (None, None)
+
+    def _operation_defaults(self, operation):
+        """Terms the query may override, quoted once per operation."""
+        defaults = self._defaults.get(operation)
+        if defaults is None:
+            defaults = self._defaults[operation] = {
+                'Operation': _quote_param('Operation', str(operation)),
+                'Service': _quote_param('Service', "AWSECommerceService"),
+                'Version': _quote_param('Version', str(self._version)),
+            }
+        return defaults
+
+    def _timestamp_param(self):
+        second = int(time.time())
+        cached_second, param = self._timestamp
+        if cached_second != second:
+            param = _quote_param('Timestamp', time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(second)))
+            self._timestamp = (second, param)
+        return param
+
+    def url(self, operation, query):
+        """The signed URL for making query against the given operation."""
+        params = dict(self._operation_defaults(operation))
+        for key, value in query.items():
+            params[key] = _quote_param(key, str(value))
+        params.update(self._overrides)
+        params['Timestamp'] = self._timestamp_param()
+
+        quoted_strings = "&".join([params[key] for key in sorted(params)])
+
+        signature = self._hmac.copy()
+        signature.update(quoted_strings.encode('utf-8'))
+
+        # base64 encode and urlencode; only + and = need escaping
+        encoded = b64encode(signature.digest()).decode('ascii')
+        encoded = encoded.replace('+', '%2B').replace('=', '%3D')
+
+        return self._url_prefix + quoted_strings + "&Signature=" + encoded
+
+
+@functools.lru_cache(maxsize=256)
+def request_signer(aws_access_key_id, aws_secret_access_key, associate_tag,
+                   service_domain, version):
+    """A RequestSigner, shared by every call with the same arguments."""
+    return RequestSigner(aws_access_key_id, aws_secret_access_key,
+                         associate_tag, service_domain, version)
+
+
+def _reject_style(kwargs):
+    if 'Style' in kwargs:
+        raise AmazonError("The `Style` parameter has been discontinued by"
+                          " AWS. Please remove all references to it and"
+                          " reattempt your request.")
+
+
 class AmazonCall(Call):
     """
     A call to the Amazon Product Advertising API.
     """
+    stream_tags = ('Item',)
+    page_param = 'ItemPage'
+    max_page = 10
+    permanent_error_statuses = (400,)
+
     def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
                  associate_tag=None, version="2013-08-01", region=None,
                  operation=None, timeout=None, max_qps=None, parser=None,
                  cache_reader=None, cache_writer=None,
-                 error_handler=None, max_retries=5, last_query_time=None):
+                 error_handler=None, max_retries=5, last_query_time=None,
+                 rate_limiter=None, transport=None, cache=None,
+                 single_flight=None, retry_policy=None, metrics=None,
+                 parsed_cache=None, stale_while_revalidate=None,
+                 negative_ttl=None, deadline=None):
         super(AmazonCall, self).__init__(operation, timeout, max_qps, parser,
                                          cache_reader, cache_writer,
                                          error_handler, max_retries,
-                                         last_query_time)
+                                         last_query_time, rate_limiter,
+                                         transport, cache, single_flight,
+                                         retry_policy, metrics, parsed_cache,
+                                         stale_while_revalidate, negative_ttl,
+                                         deadline)
 
         self.aws_access_key_id = (aws_access_key_id or
                                   os.environ.get('AWS_ACCESS_KEY_ID'))
@@ -53,79 +197,44 @@ class AmazonCall(Call):
         self.version = version
         self.region = region
 
-    def __getattr__(self, k):
-        try:
-            return super(AmazonCall, self).__getattr__(self, k)
-        except:
-            return AmazonCall(self.aws_access_key_id, self.aws_secret_access_key,
-                              self.associate_tag,
-                              version=self.version, region=self.region,
-                              operation=k, timeout=self.timeout,
-                              max_qps=self.max_qps, parser=self.parser,
-                              cache_reader=self.cache_reader,
-                              cache_writer=self.cache_writer,
-                              error_handler=self.error_handler,
-                              max_retries=self.max_retries,
-                              last_query_time=self._last_query_time)
-
-    def api_url(self, **kwargs):
-        """The URL for making the given query against the API."""
+    def _api_url(self, operation, kwargs):
+        signer = request_signer(self.aws_access_key_id,
+                                self.aws_secret_access_key,
+                                self.associate_tag,
+                                SERVICE_DOMAINS[self.region][0], self.version)
+        return signer.url(operation, kwargs)
+
+    def _cache_url(self, operation, kwargs):
         query = {
-            'Operation': self.operation,
+            'Operation': operation,
             'Service': "AWSECommerceService",
-            'Timestamp': time.strftime(
-                "%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
             'Version': self.version,
         }
         query.update(kwargs)
 
-        query['AWSAccessKeyId'] = self.aws_access_key_id
-        query['Timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
-                                           time.gmtime())
-
-        if self.associate_tag:
-            query['AssociateTag'] = self.associate_tag
-
         service_domain = SERVICE_DOMAINS[self.region][0]
-        quoted_strings = quote_query(query)
-
-        data = "GET\n" + service_domain + "\n/onca/xml\n" + quoted_strings
 
-        # convert unicode to UTF8 bytes for hmac library
-        if type(self.aws_secret_access_key) is str:
-            self.aws_secret_access_key = self.aws_secret_access_key.encode('utf-8')
+        return "https://" + service_domain + "/onca/xml?" + quote_query(query)
 
-        if type(data) is str:
-            data = data.encode('utf-8')
+    def _total_pages(self, response_text):
+        match = TOTAL_PAGES_TAG.search(response_text)
+        return int(match.group(1)) if match else None
 
-        # calculate sha256 signature
-        digest = hmac.new(self.aws_secret_access_key, data, sha256).digest()
+    def _permanent_error(self, status, body):
+        match = ERROR_CODE_TAG.search(body)
+        return match is not None and match.group(1) in PERMANENT_ERRORS
 
-        # base64 encode and urlencode
-        signature = parse.quote(b64encode(digest))
+    def _call(self, operation, kwargs):
+        _reject_style(kwargs)
+        return super(AmazonCall, self)._call(operation, kwargs)
 
-        return ("https://" + service_domain + "/onca/xml?" +
-                quoted_strings + "&Signature=%s" % signature)
+    def _call_text(self, operation, kwargs):
+        _reject_style(kwargs)
+        return super(AmazonCall, self)._call_text(operation, kwargs)
 
-    def cache_url(self, **kwargs):
-        """A simplified URL to be used for caching the given query."""
-        query = {
-            'Operation': self.operation,
-            'Service': "AWSECommerceService",
-            'Version': self.version,
-        }
-        query.update(kwargs)
-
-        service_domain = SERVICE_DOMAINS[self.region][0]
-
-        return "https://" + service_domain + "/onca/xml?" + quote_query(query)
-
-    def __call__(self, **kwargs):
-        if 'Style' in kwargs:
-            raise AmazonError("The `Style` parameter has been discontinued by"
-                              " AWS. Please remove all references to it and"
-                              " reattempt your request.")
-        return super(AmazonCall, self).__call__(**kwargs)
+    def _iter_elements(self, operation, tags, kwargs):
+        _reject_style(kwargs)
+        return super(AmazonCall, self)._iter_elements(operation, tags, kwargs)
 
 
 class Amazon(AmazonCall):
@@ -133,7 +242,11 @@ class Amazon(AmazonCall):
                  associate_tag=None, version="2013-08-01", region="US",
                  operation=None, timeout=None, max_qps=None, parser=None,
                  cache_reader=None, cache_writer=None, error_handler=None,
-                 max_retries=5):
+                 max_retries=5, rate_limiter=None, transport=None,
+                 cache=None, single_flight=None, retry_policy=None,
+                 metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None):
         """
         Create an Amazon API object.
 
@@ -156,7 +269,438 @@ class Amazon(AmazonCall):
                             cache_reader=cache_reader,
                             cache_writer=cache_writer,
                             error_handler=error_handler,
-                            max_retries=max_retries)
+                            max_retries=max_retries,
+                            rate_limiter=rate_limiter, transport=transport,
+                            cache=cache, single_flight=single_flight,
+                            retry_policy=retry_policy, metrics=metrics,
+                            parsed_cache=parsed_cache,
+                            stale_while_revalidate=stale_while_revalidate,
+                            negative_ttl=negative_ttl, deadline=deadline)
+
+
+class AmazonPool(AmazonCall):
+    """
+    An Amazon API object that spreads its calls over several sets of
+    credentials, each with its own rate limit, to multiply throughput.
+
+    Each credential set, in each region it serves, is a shard. Every call
+    goes to whichever of the shards for the pool's region has the fewest
+    calls in flight for its rate. Cache urls don't depend on credentials,
+    so the shards share one cache and coalesce identical calls.
+    """
+    shard_class = AmazonCall
+
+    def __init__(self, credentials, version="2013-08-01", region="US",
+                 operation=None, timeout=None, max_qps=0.9, parser=None,
+                 cache_reader=None, cache_writer=None, error_handler=None,
+                 max_retries=5, transport=None, cache=None,
+                 single_flight=None, retry_policy=None, metrics=None,
+                 parsed_cache=None, stale_while_revalidate=None,
+                 negative_ttl=None, deadline=None):
+        """
+        Create a pool of Amazon API credentials.
+
+        credentials: a list of (aws_access_key_id, aws_secret_access_key,
+                     associate_tag) tuples, or of dicts with those keys and
+                     optionally:
+                         regions: the regions these credentials may call;
+                                  defaults to region.
+                         max_qps: their rate limit in each region; defaults
+                                  to max_qps.
+                         rate_limiter: a rate limiter to use instead, in
+                                       every one of their regions.
+        region: the region to call; see for_region() for others.
+        max_qps: the default rate limit of each shard.
+
+        The other arguments are as for Amazon, and shared by every shard.
+        """
+        super(AmazonPool, self).__init__(
+            version=version, region=region, operation=operation,
+            timeout=timeout, parser=parser, cache_reader=cache_reader,
+            cache_writer=cache_writer, error_handler=error_handler,
+            max_retries=max_retries, transport=transport, cache=cache,
+            single_flight=single_flight, retry_policy=retry_policy,
+            metrics=metrics, parsed_cache=parsed_cache,
+            stale_while_revalidate=stale_while_revalidate,
+            negative_ttl=negative_ttl, deadline=deadline)
+
+        self.shards = {}
+        for credential in credentials:
+            if not isinstance(credential, dict):
+                credential = dict(zip(CREDENTIAL_KEYS, credential))
+
+            for shard_region in credential.get('regions') or [region]:
+                if shard_region not in SERVICE_DOMAINS:
+                    raise ValueError("Unknown region %r" % shard_region)
+                # the pool does the caching, so shards just make requests
+                shard = self.shard_class(
+                    credential['aws_access_key_id'],
+                    credential['aws_secret_access_key'],
+                    credential.get('associate_tag'), version=version,
+                    region=shard_region, timeout=timeout,
+                    max_qps=credential.get('max_qps', max_qps),
+                    error_handler=error_handler, max_retries=max_retries,
+                    rate_limiter=credential.get('rate_limiter'),
+                    transport=self.transport, single_flight=False,
+                    retry_policy=retry_policy, metrics=metrics)
+                self.shards.setdefault(shard_region, []).append(shard)
+
+        # shared with every pool for_region() makes
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._turn = 0
+
+    def __getstate__(self):
+        state = super(AmazonPool, self).__getstate__()
+        del state['_in_flight'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        super(AmazonPool, self).__setstate__(state)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def for_region(self, region):
+        """
+        This pool, calling region's API with the credentials that serve it.
+        Shares the shards, their rate limits and the cache.
+        """
+        if region not in self.shards:
+            raise ValueError("No credentials for region %r" % region)
+
+        pool = copy.copy(self)
+        # operations looked up on this pool still call this pool
+        for name, value in list(pool.__dict__.items()):
+            if isinstance(value, Operation):
+                del pool.__dict__[name]
+        pool.region = region
+        return pool
+
+    def in_flight(self):
+        """The number of calls each shard is making, by shard."""
+        with self._lock:
+            return dict(self._in_flight)
+
+    def _load(self, shard):
+        """Roughly how long a call to shard would wait. Call locked."""
+        in_flight = self._in_flight.get(shard, 0)
+        rate = getattr(shard.rate_limiter, 'rate', None)
+        # among idle shards, prefer the fastest
+        return (in_flight + 1) / rate if rate else in_flight
+
+    def _checkout(self):
+        """Pick the least loaded shard for our region, and count a call to it."""
+        shards = self.shards.get(self.region)
+        if not shards:
+            raise AmazonError("No credentials for region %r" % self.region)
+
+        with self._lock:
+            # start from a different shard each time, so ties take turns
+            self._turn = (self._turn + 1) % len(shards)
+            shard = min(shards[self._turn:] + shards[:self._turn], key=self._load)
+            self._in_flight[shard] = self._in_flight.get(shard, 0) + 1
+        return shard
+
+    def _checkin(self, shard):
+        with self._lock:
+            self._in_flight[shard] -= 1
+
+    def _api_url(self, operation, kwargs):
+        return self.shards[self.region][0]._api_url(operation, kwargs)
+
+    def _open(self, operation, cache_url, kwargs, extra_headers=None):
+        shard = self._checkout()
+        try:
+            return shard._open(operation, cache_url, kwargs, extra_headers)
+        finally:
+            self._checkin(shard)
+
+
+def split_items(response_text):
+    """
+    Split an ItemLookup response into one response per top-level <Item>.
+
+    Returns a dict mapping each item's ASIN, upper-cased, to a copy of the
+    response that contains only that item, and the response with every
+    item removed (which still carries any <Errors>). Each item's copy is the response
+    to looking up that ASIN alone: it echoes only that ItemId, and leaves
+    out <Errors>, which are about the other ItemIds.
+    """
+    spans = []
+    depth = 0
+    for match in ITEM_TAG.finditer(response_text):
+        if not match.group(1):
+            if depth == 0:
+                start = match.start()
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                end = response_text.index(b'>', match.end() - 1) + 1
+                spans.append((start, end))
+
+    if not spans:
+        return {}, response_text
+
+    prefix = response_text[:spans[0][0]]
+    suffix = response_text[spans[-1][1]:]
+
+    # errors about any ItemId come before the first item
+    item_prefix = ERRORS_TAG.sub(b'', prefix)
+
+    items = {}
+    for start, end in spans:
+        item = response_text[start:end]
+        asin = ASIN_TAG.search(item)
+        if asin:
+            asin = asin.group(1)
+            echo = ITEM_ID_TAGS.sub(lambda match: b'<ItemId>' + asin + b'</ItemId>',
+                                    item_prefix)
+            echo = ITEM_ID_ARGUMENT.sub(
+                lambda match: match.group(1) + asin + match.group(2), echo)
+            items[asin.decode('utf-8').upper()] = echo + item + suffix
+    return items, prefix + suffix
+
+
+class ItemLookupBatcher(object):
+    """
+    Collects single-ASIN ItemLookup calls and sends them to Amazon up to 10
+    ItemIds per request, so each request spends one query of the rate
+    budget on ten lookups.
+
+    Results come back per ASIN, exactly as a single-ASIN ItemLookup would
+    return them, and are written to the cache per ASIN, so later calls to
+    amazon.ItemLookup(ItemId=asin) are cache hits.
+
+    amazon: the Amazon or AmazonPool to make requests with. Awaitable
+            clients (AsyncAmazon, AsyncAmazonPool) aren't supported.
+    window: seconds to wait for more lookups before sending a partial batch.
+    max_batch: most ItemIds per request.
+    max_workers: most batch requests in flight at once.
+    """
+    def __init__(self, amazon, window=0.05, max_batch=MAX_ITEM_IDS,
+                 max_workers=4):
+        if isinstance(amazon, AsyncCall):
+            raise TypeError("ItemLookupBatcher can't make calls with %s, an"
+                            " awaitable client" % amazon.__class__.__name__)
+        self.amazon = amazon
+        self.window = window
+        self.max_batch = min(max_batch, MAX_ITEM_IDS)
+
+        # batches can only share a request if every other parameter matches
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._dispatcher = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, ItemId, **kwargs):
+        """
+        Queue a lookup of a single ItemId. Returns a Future for the
+        (parsed) response.
+        """
+        amazon = self.amazon
+        _reject_style(kwargs)
+
+        if kwargs.get('IdType', 'ASIN') != 'ASIN' or ',' in ItemId:
+            # responses can only be split back up by ASIN
+            return self._executor.submit(contextvars.copy_context().run,
+                                         amazon.ItemLookup, ItemId=ItemId, **kwargs)
+
+        # lookups with different _priority or _deadline go in different
+        # batches, as they're part of the key
+        future = Future()
+        query, _ = amazon._split_call_options(dict(kwargs, ItemId=ItemId))
+        cache_url = amazon._cache_url('ItemLookup', query)
+        parsed_entry = amazon._read_parsed('ItemLookup', cache_url)
+        if parsed_entry is not None:
+            future.set_result(parsed_entry.data)
+            return future
+        try:
+            cached_response_text = amazon._read_cache('ItemLookup', cache_url, query)
+        except HTTPError as e:
+            future.set_exception(e)
+            return future
+        if cached_response_text is not None:
+            future.set_result(amazon._parse('ItemLookup', cached_response_text,
+                                            cache_url))
+            return future
+
+        key = tuple(sorted(kwargs.items()))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("ItemLookupBatcher is closed")
+            if key not in self._pending:
+                self._pending[key] = (time.time(), [])
+            self._pending[key][1].append((ItemId, future))
+            self._condition.notify()
+
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch)
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+
+        return future
+
+    def lookup(self, ItemId, **kwargs):
+        """Look up a single ItemId, waiting for its batch to come back."""
+        return self.submit(ItemId, **kwargs).result()
+
+    def flush(self):
+        """Send every queued lookup now, without waiting for the window."""
+        with self._condition:
+            # _send() sends at most max_batch lookups and requeues the rest
+            while self._pending:
+                for key in list(self._pending):
+                    self._send(key)
+
+    def close(self):
+        """Send every queued lookup and wait for all of them to finish."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+        self._executor.shutdown()
+
+    def _dispatch(self):
+        with self._condition:
+            while True:
+                now = time.time()
+                ready = [key for key, (queued_at, lookups) in self._pending.items()
+                         if (self._closed or len(lookups) >= self.max_batch or
+                             now - queued_at >= self.window)]
+                if ready:
+                    for key in ready:
+                        self._send(key)
+                    continue
+
+                if self._closed:
+                    return
+
+                timeout = None
+                if self._pending:
+                    timeout = min(queued_at for queued_at, _ in
+                                  self._pending.values()) + self.window - now
+                self._condition.wait(timeout)
+
+    def _send(self, key):
+        """Hand up to max_batch lookups for key to the executor. Call locked."""
+        queued_at, lookups = self._pending.pop(key)
+        batch, rest = lookups[:self.max_batch], lookups[self.max_batch:]
+        if rest:
+            self._pending[key] = (time.time(), rest)
+        self._executor.submit(self._lookup, dict(key), batch)
+
+    def _lookup(self, kwargs, batch):
+        amazon = self.amazon
+        # ASINs are case-insensitive, and come back upper-case
+        item_ids = []
+        seen = set()
+        for item_id, _ in batch:
+            if item_id.upper() not in seen:
+                seen.add(item_id.upper())
+                item_ids.append(item_id)
+
+        kwargs, options = amazon._split_call_options(kwargs)
+        try:
+            query = dict(kwargs, ItemId=",".join(item_ids))
+            response_text = amazon._with_call_options(
+                options, amazon._fetch, 'ItemLookup',
+                amazon._cache_url('ItemLookup', query), query)
+            items, remainder = split_items(response_text)
+
+            results = {}
+            for item_id, _ in batch:
+                if item_id in results:
+                    continue
+                item_text = items.get(item_id.upper())
+                if item_text is None:
+                    # invalid or unavailable; the remainder carries the error
+                    results[item_id] = amazon._parse('ItemLookup', remainder)
+                    continue
+                item_cache_url = amazon._cache_url(
+                    'ItemLookup', dict(kwargs, ItemId=item_id))
+                amazon._write_cache('ItemLookup', item_cache_url, item_text)
+                results[item_id] = amazon._parse('ItemLookup', item_text,
+                                                 item_cache_url)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for item_id, future in batch:
+            future.set_result(results[item_id])
+
+
+class AsyncAmazonCall(AsyncCall, AmazonCall):
+    """
+    An awaitable call to the Amazon Product Advertising API.
+    """
+    async def _call(self, operation, kwargs):
+        _reject_style(kwargs)
+        return await AsyncCall._call(self, operation, kwargs)
+
+    async def _call_text(self, operation, kwargs):
+        _reject_style(kwargs)
+        return await AsyncCall._call_text(self, operation, kwargs)
+
+    def _iter_elements(self, operation, tags, kwargs):
+        _reject_style(kwargs)
+        return AsyncCall._iter_elements(self, operation, tags, kwargs)
+
+
+class AsyncAmazon(AsyncAmazonCall):
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+                 associate_tag=None, version="2013-08-01", region="US",
+                 operation=None, timeout=None, max_qps=None, parser=None,
+                 cache_reader=None, cache_writer=None, error_handler=None,
+                 max_retries=5, rate_limiter=None, transport=None,
+                 cache=None, single_flight=None, retry_policy=None,
+                 metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None):
+        """
+        Create an awaitable Amazon API object. Takes the same arguments as
+        Amazon; every operation returns a coroutine.
+        """
+        AsyncAmazonCall.__init__(self, aws_access_key_id,
+                                 aws_secret_access_key, associate_tag,
+                                 version=version, region=region,
+                                 operation=operation, timeout=timeout,
+                                 max_qps=max_qps, parser=parser,
+                                 cache_reader=cache_reader,
+                                 cache_writer=cache_writer,
+                                 error_handler=error_handler,
+                                 max_retries=max_retries,
+                                 rate_limiter=rate_limiter, transport=transport,
+                                 cache=cache, single_flight=single_flight,
+                                 retry_policy=retry_policy, metrics=metrics,
+                                 parsed_cache=parsed_cache,
+                                 stale_while_revalidate=stale_while_revalidate,
+                                 negative_ttl=negative_ttl, deadline=deadline)
+
+
+class AsyncAmazonPool(AsyncAmazonCall, AmazonPool):
+    """
+    An awaitable AmazonPool. Takes the same arguments; every operation
+    returns a coroutine.
+    """
+    shard_class = AsyncAmazonCall
+
+    async def _open(self, operation, cache_url, kwargs, extra_headers=None):
+        shard = self._checkout()
+        try:
+            return await shard._open(operation, cache_url, kwargs, extra_headers)
+        finally:
+            self._checkin(shard)
 
 
-__all__ = ["Amazon", "AmazonError"]
+__all__ = ["Amazon", "AmazonError", "AmazonPool", "AsyncAmazon",
+           "AsyncAmazonPool", "ItemLookupBatcher"]
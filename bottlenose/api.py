@@ -12,17 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextvars
+import copy
+import functools
 import gzip
+import io
 import logging
 import random
 import sys
+import threading
 import time
+import warnings
 
-from urllib import parse, request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from email.parser import Parser
+from http.client import HTTPMessage, responses
+from urllib import parse
+from urllib.error import HTTPError
+
+from bottlenose.cache import CacheEntry
+from bottlenose.metrics import error_name
+from bottlenose.ratelimit import TokenBucket, _reserve_within, call_priority
+from bottlenose.retry import DeadlineExceeded, call_deadline, is_throttled, time_left
+from bottlenose.stream import decoded_stream, iterparse_elements
+from bottlenose.transport import PooledTransport
 
 
 log = logging.getLogger(__name__)
 
+# keyword giving a call's class for a PriorityScheduler
+PRIORITY_KEY = '_priority'
+# keyword giving the seconds a call may take in all
+DEADLINE_KEY = '_deadline'
+
+# bytes read at a time from responses to calls with a deadline
+READ_CHUNK_SIZE = 65536
+
 
 def quote_query(query):
     """Turn a dictionary into a query string in a URL, with keys in alphabetical order."""
@@ -33,9 +61,29 @@ def quote_query(query):
 
 
 class Call(object):
+    # elements iter_elements() yields by default
+    stream_tags = ()
+
+    # HTTP statuses that mean the query itself is bad, cached for
+    # negative_ttl
+    permanent_error_statuses = (404, 410)
+
+    # threads refreshing stale responses for stale_while_revalidate
+    refresh_workers = 4
+
+    # the query parameter selecting a page of results, and the last page
+    # the API will return, for pages()
+    page_param = None
+    max_page = None
+
     def __init__(self, operation=None, timeout=None, max_qps=None,
                  parser=None, cache_reader=None, cache_writer=None,
-                 error_handler=None, max_retries=5, last_query_time=None):
+                 error_handler=None, max_retries=5, last_query_time=None,
+                 rate_limiter=None, transport=None, cache=None,
+                 single_flight=None,
+                 retry_policy=None, metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None):
         """
         operation: optional API operation.
         timeout: optional timeout for queries
@@ -59,15 +107,82 @@ class Call(object):
         error_handler: Called after an unsuccessful API call, with a
                        dictionary containing these values:
                            exception: the exception (an HTTPError or URLError)
+                           operation: the API operation
                            api_url: the url called
                            cache_url: the url used for caching purposes
                                       (see CacheReader above)
                        If this returns true, the call will be retried
                        (you generally want to wait some time before
-                       returning, in this case)
-        max_retries: Max retries.
-        last_query_time: Last query timestamp.
+                       returning, in this case). With a retry_policy, it's
+                       only notified, and the dictionary also has
+                       retry_delay: seconds until the retry, or None if
+                                    the call is giving up.
+        max_retries: Max retries, when error_handler decides them.
+        last_query_time: deprecated and ignored. Pass clients that share a
+                         rate limit the same rate_limiter instead.
+        rate_limiter: optional object whose reserve() method takes a token
+                      and returns the seconds to wait before using it, such
+                      as a TokenBucket, or a SharedTokenBucket to share one
+                      budget between processes. Overrides max_qps. If
+                      reserve() takes a max_wait keyword, calls with a
+                      deadline pass it their time left, and expect no
+                      token to be taken if the wait would be longer. If it
+                      has record_success() and record_throttle() methods,
+                      like an AdaptiveRateLimiter, they're called after
+                      each successful and throttled (503 or 429) request.
+        transport: optional object whose open(url, headers, timeout) method
+                   makes the HTTP request and returns a urlopen()-style
+                   response. Defaults to a PooledTransport, which keeps
+                   connections alive between calls; pass a UrllibTransport
+                   for a fresh connection per call.
+        cache: optional response cache, such as a TieredCache from
+               bottlenose.cache. Shorthand for cache_reader=cache.get
+               and cache_writer=cache.set. The built-in caches also keep
+               responses' ETag and Last-Modified headers, and once a
+               response expires, it's revalidated with a conditional
+               request; if unchanged, the server answers 304 and the
+               cached copy is used (and refreshed).
+        single_flight: coalesces concurrent calls with the same cache url
+                       into one API call, whose (parsed) result or exception
+                       every caller receives. Defaults to a SingleFlight
+                       shared with every operation spawned from this object;
+                       pass False to always make separate calls.
+        retry_policy: optional RetryPolicy from bottlenose.retry, which
+                      retries throttled, failed and timed out calls with
+                      exponential backoff and fails fast with
+                      CircuitOpenError while a host is down. Share one
+                      between clients to share their circuit breakers.
+        metrics: optional Metrics from bottlenose.metrics, which records
+                 how long each stage of each call takes, cache hits,
+                 retries, bytes transferred and errors. Off by default.
+        parsed_cache: optional ParsedCache from bottlenose.cache, which
+                      keeps parser's results, so that hot cache hits
+                      skip parsing. Only used along with a cache.
+        stale_while_revalidate: optional seconds after a cached response
+                                expires during which it's still returned
+                                at once, while a fresh copy is fetched in
+                                the background. Needs one of the caches in
+                                bottlenose.cache.
+        negative_ttl: optional seconds to cache errors that asking again
+                      won't fix, such as a 404 for an unknown ISBN, so
+                      they're raised again without an API call. Needs one
+                      of the caches in bottlenose.cache.
+        deadline: optional seconds each call may take in all, including
+                  waiting for the rate limiter, retries and reading the
+                  response, unlike timeout, which is per request. A call
+                  whose rate limit wait or retry would pass its deadline
+                  raises DeadlineExceeded from bottlenose.retry at once,
+                  and requests time out at the deadline. Calls can set
+                  their own with the _deadline keyword.
         """
+        if last_query_time is not None:
+            warnings.warn("last_query_time is ignored; share a rate_limiter"
+                          " between clients instead", DeprecationWarning,
+                          stacklevel=2)
+
+        if cache is not None:
+            cache_reader = cache_reader or cache.get
+            cache_writer = cache_writer or cache.set
 
         self.operation = operation
         self.cache_reader = cache_reader
@@ -77,23 +192,326 @@ class Call(object):
         self.parser = parser
         self.timeout = timeout
         self.max_retries = max_retries
+        self.cache = cache
+        self.retry_policy = retry_policy
+        self.metrics = metrics
+        self.parsed_cache = parsed_cache
+        self.stale_while_revalidate = stale_while_revalidate
+        self.negative_ttl = negative_ttl
+        self.deadline = deadline
+
+        # cache urls being refreshed in the background, and their futures
+        self._refreshing = {}
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+
+        # shared with every operation spawned from this object
+        if rate_limiter is None and max_qps:
+            rate_limiter = TokenBucket(max_qps)
+        self.rate_limiter = rate_limiter
+
+        self.transport = transport or self._default_transport()
 
-        # put this in a list so it can be shared between instances
-        self._last_query_time = last_query_time or [None]
+        if single_flight is None:
+            single_flight = self._default_single_flight()
+        self.single_flight = single_flight
+
+    def __getstate__(self):
+        # background refreshes and locks stay with this process, and
+        # operations are made again on first use
+        state = self.__dict__.copy()
+        for name, value in self.__dict__.items():
+            if isinstance(value, Operation):
+                del state[name]
+        for name in ('_refreshing', '_refresh_lock', '_refresher'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._refreshing = {}
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+
+    def __copy__(self):
+        # copies share everything with the original, locks included
+        call = object.__new__(self.__class__)
+        call.__dict__.update(self.__dict__)
+        return call
+
+    def __getattr__(self, k):
+        # only reached for names that aren't real attributes, i.e. API
+        # operations. Each is created once and stored on the instance, so
+        # later lookups of the same name never come back here.
+        if k.startswith('_'):
+            raise AttributeError(k)
+        operation = self.__dict__[k] = Operation(self, k)
+        return operation
+
+    def _default_transport(self):
+        return PooledTransport()
+
+    def _default_single_flight(self):
+        return SingleFlight()
 
     def api_url(self, **kwargs):
-        raise NotImplementedError
+        """The URL for making the given query against the API."""
+        return self._implementation('_api_url')(self, self.operation, kwargs)
 
     def cache_url(self, **kwargs):
+        """A simplified URL to be used for caching the given query."""
+        return self._implementation('_cache_url')(self, self.operation, kwargs)
+
+    def _api_url(self, operation, kwargs):
+        raise NotImplementedError
+
+    def _cache_url(self, operation, kwargs):
         raise NotImplementedError
 
+    def __init_subclass__(cls, **kwargs):
+        super(Call, cls).__init_subclass__(**kwargs)
+        # subclasses written before operations were passed around override
+        # api_url() and cache_url(), reading self.operation; call those
+        if 'api_url' in cls.__dict__ and '_api_url' not in cls.__dict__:
+            cls._api_url = Call._legacy_api_url
+        if 'cache_url' in cls.__dict__ and '_cache_url' not in cls.__dict__:
+            cls._cache_url = Call._legacy_cache_url
+
+    def _implementation(self, name):
+        """
+        The nearest real _api_url() or _cache_url(), skipping those that
+        call back into an overridden api_url() or cache_url(), so that
+        overrides can call the version they override with super().
+        """
+        for cls in type(self).__mro__:
+            method = cls.__dict__.get(name)
+            if method is not None and method not in (Call._legacy_api_url,
+                                                      Call._legacy_cache_url):
+                return method
+        raise AttributeError(name)
+
+    def _legacy_api_url(self, operation, kwargs):
+        return self._for_operation(operation).api_url(**kwargs)
+
+    def _legacy_cache_url(self, operation, kwargs):
+        return self._for_operation(operation).cache_url(**kwargs)
+
+    def _for_operation(self, operation):
+        """This object, or a shallow copy of it, with operation set."""
+        if operation == self.operation:
+            return self
+        call = copy.copy(self)
+        call.operation = operation
+        return call
+
+    def _total_pages(self, response_text):
+        """The number of pages of results, read from the first page."""
+        return None
+
     def _maybe_parse(self, response_text):
         if self.parser:
             return self.parser(response_text)
         else:
             return response_text
 
-    def _call_api(self, api_url, err_env):
+    def _parse(self, operation, response_text, cache_url=None):
+        """
+        _maybe_parse(), timed. The result is written to the parsed cache
+        under cache_url, if given.
+        """
+        if not (self.metrics and self.parser):
+            result = self._maybe_parse(response_text)
+        else:
+            start = time.perf_counter()
+            result = self._maybe_parse(response_text)
+            self.metrics.observe(operation, 'parse', time.perf_counter() - start)
+
+        if cache_url is not None and self._caches_parsed():
+            self._cache_parsed(cache_url, result)
+        return result
+
+    def _caches_parsed(self):
+        # parsed responses expire with the responses they were parsed
+        # from, so there's nothing to keep them for without a cache
+        return (self.parsed_cache is not None and self.parser is not None and
+                self.cache_reader is not None)
+
+    def _cache_parsed(self, cache_url, result):
+        """
+        Write result, parsed from the cached response for cache_url, to the
+        parsed cache, expiring with that response. Nothing is written if
+        the response has expired or is an error, so those calls still go
+        through stale_while_revalidate, revalidation and negative caching.
+        """
+        expires = None
+        if self._keeps_entries():
+            entry = self.cache.lookup(cache_url)
+            if entry is None or entry.status is not None:
+                return
+            expires = entry.expires
+        self.parsed_cache.set(self.parser, cache_url, result, expires=expires)
+
+    def _read_parsed(self, operation, cache_url):
+        """The CacheEntry of the parsed response for cache_url, or None."""
+        if not self._caches_parsed():
+            return None
+
+        entry = self.parsed_cache.lookup(self.parser, cache_url)
+        if self.metrics:
+            self.metrics.increment(
+                operation, 'parsed_miss' if entry is None else 'parsed_hit')
+        return entry
+
+    def _read_cache(self, operation, cache_url, kwargs=None):
+        """
+        The cached (unparsed) response for cache_url, or None. Raises the
+        cached error for a url in the negative cache. Given the query's
+        kwargs, returns a recently expired response too, and refreshes it
+        in the background (see stale_while_revalidate).
+        """
+        if not self.cache_reader:
+            return None
+        if not self.metrics:
+            return self._cached_response_text(operation, cache_url, kwargs)
+
+        start = time.perf_counter()
+        cached_response_text = self._cached_response_text(operation, cache_url, kwargs)
+        self.metrics.observe(operation, 'cache', time.perf_counter() - start)
+        self.metrics.increment(
+            operation, 'cache_miss' if cached_response_text is None else 'cache_hit')
+        return cached_response_text
+
+    def _reads_entries(self):
+        """Whether reading the cache needs whole CacheEntry objects."""
+        return self._keeps_entries() and (self.stale_while_revalidate or
+                                          self.negative_ttl is not None)
+
+    def _cached_response_text(self, operation, cache_url, kwargs):
+        if not self._reads_entries():
+            return self.cache_reader(cache_url)
+
+        entry = self.cache.lookup(cache_url, stale=bool(self.stale_while_revalidate))
+        if entry is None:
+            return None
+
+        if entry.status is not None:
+            # don't serve errors past negative_ttl
+            if entry.expired():
+                return None
+            if self.metrics:
+                self.metrics.increment(operation, 'negative_hit')
+            raise _cached_error(cache_url, entry)
+
+        if entry.expired():
+            if (kwargs is None or
+                    time.time() - entry.expires > self.stale_while_revalidate):
+                return None
+            if self.metrics:
+                self.metrics.increment(operation, 'stale_hit')
+            self._refresh_in_background(operation, cache_url, kwargs)
+
+        return entry.data
+
+    def _refresh_in_background(self, operation, cache_url, kwargs):
+        """Fetch cache_url again in a thread, unless that's already underway."""
+        with self._refresh_lock:
+            if cache_url in self._refreshing:
+                return
+            if self._refresher is None:
+                self._refresher = ThreadPoolExecutor(self.refresh_workers)
+            self._refreshing[cache_url] = self._refresher.submit(
+                self._refresh, operation, cache_url, kwargs)
+
+    def _refresh(self, operation, cache_url, kwargs):
+        try:
+            # like any other call, so that calls made once the response is
+            # too stale to return wait for this one
+            if self.single_flight:
+                self.single_flight.do(
+                    cache_url, lambda: self._request(operation, cache_url, kwargs))
+            else:
+                self._request(operation, cache_url, kwargs)
+        except Exception as e:
+            log.debug("Couldn't refresh %s: %r" % (cache_url, e))
+        finally:
+            with self._refresh_lock:
+                del self._refreshing[cache_url]
+
+    def _write_cache(self, operation, cache_url, response_text,
+                     etag=None, last_modified=None):
+        if not self.cache_writer:
+            return
+
+        cache_writer = self.cache_writer
+        if (etag or last_modified) and self._keeps_entries():
+            cache_writer = functools.partial(self.cache.set, etag=etag,
+                                             last_modified=last_modified)
+
+        if not self.metrics:
+            cache_writer(cache_url, response_text)
+            return
+
+        start = time.perf_counter()
+        cache_writer(cache_url, response_text)
+        self.metrics.observe(operation, 'cache_write', time.perf_counter() - start)
+
+    def _keeps_entries(self):
+        """
+        Whether our cache is one of the caches in bottlenose.cache, whose
+        entries keep validators for conditional requests, expiry times and
+        errors.
+        """
+        return (self.cache is not None and hasattr(self.cache, 'lookup') and
+                self.cache_reader == self.cache.get and
+                self.cache_writer == self.cache.set)
+
+    def _stale_entry(self, cache_url):
+        """An expired CacheEntry for cache_url that can be revalidated, or None."""
+        if not self._keeps_entries():
+            return None
+        entry = self.cache.lookup(cache_url, stale=True)
+        if (entry is None or entry.status is not None or
+                not entry.revalidation_headers()):
+            return None
+        return entry
+
+    def _permanent_error(self, status, body):
+        """
+        Whether an error response with one of permanent_error_statuses
+        means the query itself is bad.
+        """
+        return True
+
+    def _negative_cache(self, operation, cache_url, exception):
+        """
+        Cache exception, an HTTPError, if we're negative caching and it's
+        permanent. Returns the exception to raise in its place, whose body
+        has been decompressed if it's been read.
+        """
+        if (self.negative_ttl is None or not self._keeps_entries() or
+                exception.code not in self.permanent_error_statuses):
+            return exception
+
+        body = exception.read()
+        content_encoding = exception.headers.get("Content-Encoding")
+        if content_encoding and "gzip" in content_encoding:
+            body = gzip.decompress(body)
+
+        # the body is kept decompressed
+        headers = HTTPMessage()
+        for name, value in exception.headers.items():
+            if name.lower() not in ('content-encoding', 'content-length',
+                                    'transfer-encoding'):
+                headers[name] = value
+
+        entry = CacheEntry(body, status=exception.code, headers=headers.as_string())
+        if self._permanent_error(exception.code, body):
+            log.debug("Caching %d for %s" % (exception.code, cache_url))
+            self.cache.set(cache_url, body, ttl=self.negative_ttl,
+                           status=exception.code, headers=entry.headers)
+        return _cached_error(exception.url, entry)
+
+    def _call_api(self, api_url, err_env, extra_headers=None):
         """
         urlopen(), plus error handling and possible retries.
 
@@ -102,62 +520,548 @@ class Call(object):
         attempt = 0
         while True:  # may retry on error
             attempt += 1
-            api_request = request.Request(
-                api_url, headers={"Accept-Encoding": "gzip",
-                                  "User-Agent": random_desktop_user_agent()})
+            headers = {"Accept-Encoding": "gzip",
+                       "User-Agent": random_desktop_user_agent()}
+            if extra_headers:
+                headers.update(extra_headers)
 
             log.debug("API URL: %s" % api_url)
 
+            # outside the try, so a passed deadline isn't retried or
+            # counted against the host; this also catches a deadline that
+            # passed while error_handler waited
+            timeout = self._attempt_timeout()
+
+            if self.retry_policy:
+                self.retry_policy.check(api_url)
+
             try:
-                # the simple way
-                return request.urlopen(api_request, timeout=self.timeout)
+                response = self.transport.open(api_url, headers, timeout=timeout)
             except:
-                if not self.error_handler or attempt > self.max_retries:
-                    raise
-
                 exception = sys.exc_info()[1]
+                self._record_outcome(exception)
+                if self.metrics:
+                    self.metrics.increment(err_env.get('operation'),
+                                           error_name(exception))
                 err = {'exception': exception}
                 err.update(err_env)
-                if not self.error_handler(err):
+
+                if self.retry_policy:
+                    retry_delay = self.retry_policy.record_failure(
+                        api_url, attempt, exception)
+                    if self.error_handler:
+                        err['retry_delay'] = retry_delay
+                        self.error_handler(err)
+                    if retry_delay is None:
+                        raise
+                    self._check_retry_delay(retry_delay)
+                    log.debug('Retrying in %.3fs after %r' % (retry_delay, exception))
+                    time.sleep(retry_delay)
+                elif not self.error_handler or attempt > self.max_retries:
+                    raise
+                elif not self.error_handler(err):
                     raise
 
-    def __call__(self, **kwargs):
-        cache_url = self.cache_url(**kwargs)
+                if self.metrics:
+                    self.metrics.increment(err_env.get('operation'), 'retries')
+            else:
+                self._record_outcome()
+                if self.retry_policy:
+                    self.retry_policy.record_success(api_url)
+                return response
 
-        if self.cache_reader:
-            cached_response_text = self.cache_reader(cache_url)
-            if cached_response_text is not None:
-                return self._maybe_parse(cached_response_text)
+    def _attempt_timeout(self):
+        """
+        The timeout for a request: timeout, cut short by the deadline of
+        the call being made. Raises DeadlineExceeded if that has passed.
+        """
+        left = time_left()
+        if left is None:
+            return self.timeout
+        if left <= 0:
+            raise DeadlineExceeded("Deadline passed before the request was made")
+        return left if self.timeout is None else min(self.timeout, left)
 
-        api_url = self.api_url(**kwargs)
+    def _check_retry_delay(self, retry_delay):
+        """Raise DeadlineExceeded if retrying would pass the call's deadline."""
+        left = time_left()
+        if left is not None and retry_delay >= left:
+            raise DeadlineExceeded(
+                "Retrying in %.3fs would pass the deadline, %.3fs away" %
+                (retry_delay, left))
 
-        # throttle ourselves if need be
-        if self.max_qps:
-            last_query_time = self._last_query_time[0]
-            if last_query_time:
-                wait_time = 1 / self.max_qps - (time.time() - last_query_time)
-                if wait_time > 0:
-                    log.debug('Waiting %.3fs to call API' % wait_time)
-                    time.sleep(wait_time)
+    def _reserve(self):
+        """
+        Take a token from the rate limiter, returning the seconds to wait
+        before using it. Raises DeadlineExceeded, without taking one, if the
+        wait would pass the deadline of the call being made.
+        """
+        left = time_left()
+        if left is None:
+            return self.rate_limiter.reserve()
 
-            self._last_query_time[0] = time.time()
+        wait_time = _reserve_within(self.rate_limiter, left)
+        if wait_time > left:
+            raise DeadlineExceeded(
+                "Rate limit wait would pass the deadline, %.3fs away" % left)
+        return wait_time
+
+    def _record_outcome(self, exception=None):
+        """Tell an adaptive rate limiter how a request went."""
+        if exception is None:
+            record = getattr(self.rate_limiter, 'record_success', None)
+        elif is_throttled(exception):
+            record = getattr(self.rate_limiter, 'record_throttle', None)
+        else:
+            return
+        if record:
+            record()
+
+    def _throttle(self, operation):
+        if not self.rate_limiter:
+            return
+
+        if self.metrics:
+            start = time.perf_counter()
+        # a PriorityScheduler does its waiting in reserve()
+        wait_time = self._reserve()
+        if wait_time > 0:
+            log.debug('Waiting %.3fs to call API' % wait_time)
+            time.sleep(wait_time)
+        if self.metrics:
+            self.metrics.observe(operation, 'throttle', time.perf_counter() - start)
+
+    def _open(self, operation, cache_url, kwargs, extra_headers=None):
+        """
+        Throttle and call the API, bypassing the cache. Returns the
+        response, with its body still unread.
+        """
+        # throttle before signing, so a long wait can't expire the timestamp
+        self._throttle(operation)
+
+        metrics = self.metrics
+        if metrics:
+            start = time.perf_counter()
+        api_url = self._api_url(operation, kwargs)
+        if metrics:
+            metrics.observe(operation, 'sign', time.perf_counter() - start)
 
         # make the actual API call
-        response = self._call_api(api_url, {'api_url': api_url, 'cache_url': cache_url})
+        err_env = {'operation': operation, 'api_url': api_url, 'cache_url': cache_url}
+        if not metrics:
+            return self._call_api(api_url, err_env, extra_headers)
+
+        start = time.perf_counter()
+        response = self._call_api(api_url, err_env, extra_headers)
+        metrics.observe(operation, 'network', time.perf_counter() - start)
+        return response
+
+    def _fetch(self, operation, cache_url, kwargs):
+        """
+        Throttle, call the API and return the decompressed response,
+        bypassing the cache.
+        """
+        return self._decode(operation, self._open(operation, cache_url, kwargs))
+
+    def _decode(self, operation, response):
+        """Read response's body, decompressing it if need be."""
+        if self.metrics:
+            return self._decode_timed(operation, response)
 
-        # decompress the response if need be
         content_encoding = response.info().get("Content-Encoding")
         if content_encoding and "gzip" in content_encoding:
-            response_text = gzip.decompress(response.read())
+            return gzip.decompress(self._read(response))
         else:
-            response_text = response.read()
+            return self._read(response)
+
+    def _read(self, response):
+        """
+        Read response's body, a chunk at a time if the call being made has
+        a deadline, so as to give up once it passes.
+        """
+        if call_deadline.get() is None:
+            return response.read()
+
+        chunks = []
+        while True:
+            if time_left() <= 0:
+                response.close()
+                raise DeadlineExceeded("Deadline passed reading the response")
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def _fetch_and_store(self, operation, cache_url, kwargs):
+        """
+        Like _fetch(), but writes the response to the cache, and if the
+        cache has an expired copy with validators, asks the API whether it
+        has changed rather than for the whole response again.
+        """
+        stale_entry = self._stale_entry(cache_url)
+        extra_headers = stale_entry.revalidation_headers() if stale_entry else None
+
+        try:
+            response = self._open(operation, cache_url, kwargs, extra_headers)
+        except HTTPError as e:
+            raise self._negative_cache(operation, cache_url, e)
+        return self._store(operation, cache_url, response, stale_entry)
+
+    def _store(self, operation, cache_url, response, stale_entry):
+        """Read response and write it to the cache, returning its body."""
+        response_text, etag, last_modified = self._revalidated(
+            operation, cache_url, response, self._decode(operation, response),
+            stale_entry)
+
+        self._write_cache(operation, cache_url, response_text, etag, last_modified)
+        return response_text
 
-        # write it back to the cache
-        if self.cache_writer:
-            self.cache_writer(cache_url, response_text)
+    def _revalidated(self, operation, cache_url, response, response_text,
+                     stale_entry):
+        """
+        The body, ETag and Last-Modified date to cache for a response.
+        For a 304 Not Modified, that's stale_entry's body.
+        """
+        headers = response.info()
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+
+        if stale_entry is not None and response.getcode() == 304:
+            log.debug("Not modified: %s" % cache_url)
+            if self.metrics:
+                self.metrics.increment(operation, 'not_modified')
+            response_text = stale_entry.data
+            etag = etag or stale_entry.etag
+            last_modified = last_modified or stale_entry.last_modified
+
+        return response_text, etag, last_modified
+
+    def _decode_timed(self, operation, response, body=None):
+        """
+        Read (unless body is given) and decompress response, recording
+        how long each takes and the bytes before and after.
+        """
+        metrics = self.metrics
+        if body is None:
+            start = time.perf_counter()
+            body = self._read(response)
+            metrics.observe(operation, 'download', time.perf_counter() - start)
+        metrics.increment(operation, 'bytes_received', len(body))
+
+        content_encoding = response.info().get("Content-Encoding")
+        if content_encoding and "gzip" in content_encoding:
+            start = time.perf_counter()
+            body = gzip.decompress(body)
+            metrics.observe(operation, 'decode', time.perf_counter() - start)
+        metrics.increment(operation, 'bytes_decoded', len(body))
+        return body
+
+    def __call__(self, **kwargs):
+        return self._invoke(self.operation, kwargs)
+
+    def _invoke(self, operation, kwargs, call=None):
+        """
+        Make the call with call (_call() by default), with the call's
+        priority class and deadline set for its duration; see
+        _set_call_options().
+        """
+        kwargs, options = self._split_call_options(kwargs)
+        return self._with_call_options(options, call or self._call,
+                                       operation, kwargs)
+
+    def _split_call_options(self, kwargs):
+        """
+        Return kwargs without the _priority and _deadline keywords, and a
+        dict of just those.
+        """
+        if PRIORITY_KEY not in kwargs and DEADLINE_KEY not in kwargs:
+            return kwargs, {}
+
+        kwargs = dict(kwargs)
+        options = {}
+        for key in (PRIORITY_KEY, DEADLINE_KEY):
+            if key in kwargs:
+                options[key] = kwargs.pop(key)
+        return kwargs, options
+
+    def _with_call_options(self, options, fn, *args):
+        """Return fn(*args), with options set for its duration."""
+        if not options and self.deadline is None:
+            return fn(*args)
+
+        tokens = self._set_call_options(options)
+        try:
+            return fn(*args)
+        finally:
+            self._reset_call_options(tokens)
+
+    def _set_call_options(self, options):
+        """
+        Set the _priority and _deadline options for the call being made,
+        the deadline defaulting to deadline. A call made within another
+        keeps to the outer call's deadline too. Returns the tokens to reset
+        them with.
+        """
+        tokens = []
+        if PRIORITY_KEY in options:
+            tokens.append(call_priority.set(options[PRIORITY_KEY]))
+
+        seconds = options.get(DEADLINE_KEY, self.deadline)
+        if seconds is not None:
+            deadline = time.monotonic() + seconds
+            outer_deadline = call_deadline.get()
+            if outer_deadline is not None:
+                deadline = min(deadline, outer_deadline)
+            tokens.append(call_deadline.set(deadline))
+        return tokens
+
+    def _reset_call_options(self, tokens):
+        for token in reversed(tokens):
+            token.var.reset(token)
+
+    def _call(self, operation, kwargs):
+        cache_url = self._cache_url(operation, kwargs)
+
+        parsed_entry = self._read_parsed(operation, cache_url)
+        if parsed_entry is not None:
+            return parsed_entry.data
+
+        cached_response_text = self._read_cache(operation, cache_url, kwargs)
+        if cached_response_text is not None:
+            return self._parse(operation, cached_response_text, cache_url)
+
+        if self.single_flight:
+            return self.single_flight.do(
+                cache_url, lambda: self._request(operation, cache_url, kwargs))
+        return self._request(operation, cache_url, kwargs)
+
+    def _request(self, operation, cache_url, kwargs):
+        # fetch it and write it back to the cache
+        response_text = self._fetch_and_store(operation, cache_url, kwargs)
 
         # parse and return it
-        return self._maybe_parse(response_text)
+        return self._parse(operation, response_text, cache_url)
+
+    def _call_text(self, operation, kwargs):
+        """Like _call(), but returns the unparsed response."""
+        cache_url = self._cache_url(operation, kwargs)
+
+        cached_response_text = self._read_cache(operation, cache_url, kwargs)
+        if cached_response_text is not None:
+            return cached_response_text
+
+        return self._fetch_and_store(operation, cache_url, kwargs)
+
+    def _page_queries(self, first_response_text, kwargs, max_pages):
+        """The queries for the pages after the first, up to max_pages in all."""
+        first_page = int(kwargs.get(self.page_param, 1))
+        last_page = self._total_pages(first_response_text) or first_page
+        if self.max_page:
+            last_page = min(last_page, self.max_page)
+        if max_pages:
+            last_page = min(last_page, first_page + max_pages - 1)
+
+        return [dict(kwargs, **{self.page_param: page})
+                for page in range(first_page + 1, last_page + 1)]
+
+    def pages(self, max_pages=None, prefetch=2, **kwargs):
+        """
+        Make the call and yield the (parsed) response for each page of
+        results in turn, e.g. each ItemPage of an ItemSearch.
+
+        The number of pages is read from the first response. While the
+        caller works on one page, up to prefetch of the following pages
+        are fetched in the background, still subject to the rate limiter
+        and cache. Closing the generator early cancels pages not yet
+        started.
+
+        max_pages: optional limit on the number of pages yielded.
+        prefetch: how many pages to fetch ahead of the one yielded.
+        """
+        return self._pages(self.operation, max_pages, prefetch, kwargs)
+
+    def _pages(self, operation, max_pages, prefetch, kwargs):
+        if not self.page_param:
+            raise ValueError("%s results can't be paged" % self.__class__.__name__)
+
+        # each page is a call of its own, with its own deadline
+        kwargs, options = self._split_call_options(kwargs)
+        first_response_text = self._with_call_options(
+            options, self._call_text, operation, kwargs)
+        queries = deque(self._page_queries(first_response_text, kwargs, max_pages))
+
+        yield self._parse(operation, first_response_text)
+        if not queries:
+            return
+
+        prefetch = max(1, prefetch)
+        executor = ThreadPoolExecutor(prefetch)
+        fetching = deque()
+        try:
+            while queries or fetching:
+                while queries and len(fetching) < prefetch:
+                    fetching.append(executor.submit(
+                        contextvars.copy_context().run, self._with_call_options,
+                        options, self._call, operation, queries.popleft()))
+                yield fetching.popleft().result()
+        finally:
+            for future in fetching:
+                future.cancel()
+            executor.shutdown()
+
+    def iter_elements(self, tags=None, **kwargs):
+        """
+        Make the call and yield the XML elements named in tags (by default
+        stream_tags, e.g. each <Item> of an Amazon response) one at a time.
+
+        The response is decompressed and parsed incrementally, and each
+        element is freed once the next one is requested, so large
+        responses are processed in bounded memory and the first element
+        arrives before the last byte does. Elements are ElementTree
+        elements; parser is not applied. A cached response is streamed
+        from the cache, but streamed responses aren't written to it.
+        """
+        return self._iter_elements(self.operation, tags, kwargs)
+
+    def _iter_elements(self, operation, tags, kwargs):
+        tags = tags or self.stream_tags
+        if not tags:
+            raise ValueError("No tags given to iterate over")
+
+        kwargs, options = self._split_call_options(kwargs)
+        cache_url = self._cache_url(operation, kwargs)
+
+        cached_response_text = self._read_cache(operation, cache_url)
+        if cached_response_text is not None:
+            for element in iterparse_elements(io.BytesIO(cached_response_text), tags):
+                yield element
+            return
+
+        # the deadline covers the request; the elements are read as they're
+        # asked for
+        response = self._with_call_options(
+            options, self._open, operation, cache_url, kwargs)
+        try:
+            for element in iterparse_elements(decoded_stream(response), tags):
+                yield element
+        finally:
+            response.close()
+
+
+class Operation(object):
+    """
+    One operation of a client, e.g. amazon.ItemLookup.
+
+    Created once per operation name and kept on the client. It holds no
+    configuration of its own: calls go straight to the client, and any
+    other attribute is read from it.
+    """
+    __slots__ = ('client', 'operation')
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def __getattr__(self, k):
+        return getattr(self.client, k)
+
+    def __repr__(self):
+        return "<%s %s.%s>" % (self.__class__.__name__,
+                               self.client.__class__.__name__, self.operation)
+
+    def __call__(self, **kwargs):
+        return self.client._invoke(self.operation, kwargs)
+
+    def api_url(self, **kwargs):
+        """The URL for making the given query against the API."""
+        return self.client._api_url(self.operation, kwargs)
+
+    def cache_url(self, **kwargs):
+        """A simplified URL to be used for caching the given query."""
+        return self.client._cache_url(self.operation, kwargs)
+
+    def iter_elements(self, tags=None, **kwargs):
+        """See Call.iter_elements()."""
+        return self.client._iter_elements(self.operation, tags, kwargs)
+
+    def pages(self, max_pages=None, prefetch=2, **kwargs):
+        """See Call.pages()."""
+        return self.client._pages(self.operation, max_pages, prefetch, kwargs)
+
+
+def _cached_error(url, entry):
+    """An HTTPError like the one whose status, headers and body entry holds."""
+    headers = Parser(_class=HTTPMessage).parsestr(entry.headers or "")
+    return HTTPError(url, entry.status, responses.get(entry.status, ""),
+                     headers, io.BytesIO(entry.data))
+
+
+def _own_error(exception):
+    """
+    A copy of exception, an HTTPError, with its own unread copy of the body,
+    so callers sharing one error don't drain its body for each other.
+    """
+    if isinstance(exception.fp, io.BytesIO):
+        body = exception.fp.getvalue()
+    else:
+        body = exception.read()
+    return HTTPError(exception.filename, exception.code, exception.msg,
+                     exception.hdrs, io.BytesIO(body))
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key, so only the first caller
+    does the work and everyone waiting on it gets its result or exception.
+    Safe to share between threads.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # calls in flight aren't shared with copies
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the fn() already running for key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            # the leader keeps to its own deadline, and we to ours
+            try:
+                call.exception(time_left())
+            except FutureTimeoutError:
+                raise DeadlineExceeded("Deadline passed waiting for the same call")
+            error = call.exception()
+            if isinstance(error, HTTPError):
+                raise _own_error(error).with_traceback(error.__traceback__)
+            return call.result()
+
+        try:
+            result = fn()
+        except HTTPError as e:
+            # everyone gets their own copy, so reading one doesn't leave
+            # the others an empty body
+            error = _own_error(e)
+            call.set_exception(error)
+            raise _own_error(error).with_traceback(e.__traceback__) from None
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
 
 
 def random_desktop_user_agent():
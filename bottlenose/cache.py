@@ -0,0 +1,649 @@
+import hashlib
+import inspect
+import json
+import logging
+import mmap
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+    """
+    A cached response.
+
+    data: the (unparsed) response.
+    expires: time.time() after which the entry is stale, or None.
+    etag, last_modified: the response's ETag and Last-Modified headers,
+                         if any, with which a stale entry can be
+                         revalidated instead of downloaded again.
+    status: for a cached error, its HTTP status, e.g. 404; data is the
+            error's body. None for a successful response.
+    headers: for a cached error, its headers (e.g. Retry-After) as text,
+             one "Name: value" line each.
+    """
+    __slots__ = ('data', 'expires', 'etag', 'last_modified', 'status',
+                 'headers')
+
+    def __init__(self, data, expires=None, etag=None, last_modified=None,
+                 status=None, headers=None):
+        self.data = data
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.status = status
+        self.headers = headers
+
+    def expired(self, now=None):
+        return self.expires is not None and (now or time.time()) >= self.expires
+
+    def revalidation_headers(self):
+        """Headers asking the server for the response only if it has changed."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+def _expires(ttl):
+    return time.time() + ttl if ttl is not None else None
+
+
+class LRUCache(object):
+    """
+    A bounded in-memory response cache, safe to share between threads.
+    Pass cache.get as cache_reader and cache.set as cache_writer, or the
+    cache itself as cache.
+
+    max_entries: the most responses kept; least recently used go first.
+    max_bytes: optional bound on the total size of the kept responses.
+    ttl: optional default seconds a response stays fresh. Expired
+         responses with an ETag or Last-Modified date are kept, so they
+         can be revalidated.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, url, stale=False):
+        """
+        Return the CacheEntry for url, or None if missing or expired
+        (unless stale is true).
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            if entry.expired() and not stale:
+                if not entry.revalidation_headers():
+                    self._remove(url)
+                return None
+            self._entries.move_to_end(url)
+            return entry
+
+    def get(self, url):
+        """The response for url, or None if missing, expired or an error."""
+        entry = self.lookup(url)
+        return entry.data if entry is not None and entry.status is None else None
+
+    def put(self, url, entry):
+        with self._lock:
+            if url in self._entries:
+                self._remove(url)
+            self._entries[url] = entry
+            self._size += len(entry.data)
+
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    (self.max_bytes is not None and self._size > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def set(self, url, data, ttl=None, etag=None, last_modified=None,
+            status=None, headers=None):
+        self.put(url, CacheEntry(data, _expires(ttl if ttl is not None else self.ttl),
+                                 etag, last_modified, status, headers))
+
+    def delete(self, url):
+        with self._lock:
+            if url in self._entries:
+                self._remove(url)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, url):
+        self._size -= len(self._entries.pop(url).data)
+
+
+class SQLiteCache(object):
+    """
+    A compressed on-disk response cache kept in a single SQLite file, safe
+    to share between threads and processes.
+
+    path: the database file; created if missing.
+    ttl: optional default seconds a response stays fresh. Expired
+         responses with an ETag or Last-Modified date are kept until
+         purge(), so they can be revalidated.
+    max_bytes: optional bound on the size of the database; the least
+               recently stored responses are evicted past it.
+    compress_level: zlib level used for stored responses.
+    """
+    def __init__(self, path, ttl=None, max_bytes=None, compress_level=6):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " url TEXT PRIMARY KEY,"
+            " data BLOB NOT NULL,"
+            " expires REAL,"
+            " stored REAL NOT NULL,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " status INTEGER,"
+            " headers TEXT)")
+        self._connection().execute(
+            "CREATE INDEX IF NOT EXISTS responses_stored ON responses (stored)")
+
+        # databases from before validators and errors were stored
+        columns = [row[1] for row in
+                   self._connection().execute("PRAGMA table_info(responses)")]
+        for column, column_type in (('etag', 'TEXT'), ('last_modified', 'TEXT'),
+                                    ('status', 'INTEGER'), ('headers', 'TEXT')):
+            if column not in columns:
+                self._connection().execute(
+                    "ALTER TABLE responses ADD COLUMN %s %s" % (column, column_type))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads or processes
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def __len__(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def lookup(self, url, stale=False):
+        """
+        Return the CacheEntry for url, or None if missing or expired
+        (unless stale is true).
+        """
+        row = self._connection().execute(
+            "SELECT data, expires, etag, last_modified, status, headers"
+            " FROM responses"
+            " WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+
+        entry = CacheEntry(zlib.decompress(row[0]), *row[1:])
+        if entry.expired() and not stale:
+            if not entry.revalidation_headers():
+                self.delete(url)
+            return None
+        return entry
+
+    def get(self, url):
+        """The response for url, or None if missing, expired or an error."""
+        entry = self.lookup(url)
+        return entry.data if entry is not None and entry.status is None else None
+
+    def put(self, url, entry):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses"
+            " (url, data, expires, stored, etag, last_modified, status, headers)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, zlib.compress(entry.data, self.compress_level),
+             entry.expires, time.time(), entry.etag, entry.last_modified,
+             entry.status, entry.headers))
+
+        if self.max_bytes is not None:
+            self._evict(connection)
+
+    def set(self, url, data, ttl=None, etag=None, last_modified=None,
+            status=None, headers=None):
+        self.put(url, CacheEntry(data, _expires(ttl if ttl is not None else self.ttl),
+                                 etag, last_modified, status, headers))
+
+    def delete(self, url):
+        self._connection().execute("DELETE FROM responses WHERE url = ?", (url,))
+
+    def purge(self):
+        """Delete every expired response."""
+        self._connection().execute(
+            "DELETE FROM responses WHERE expires <= ?", (time.time(),))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM responses")
+
+    def _used_bytes(self, connection):
+        page_size, = connection.execute("PRAGMA page_size").fetchone()
+        page_count, = connection.execute("PRAGMA page_count").fetchone()
+        free_count, = connection.execute("PRAGMA freelist_count").fetchone()
+        return (page_count - free_count) * page_size
+
+    def _evict(self, connection):
+        while self._used_bytes(connection) > self.max_bytes:
+            count, = connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count <= 1:
+                return
+            connection.execute(
+                "DELETE FROM responses WHERE url IN"
+                " (SELECT url FROM responses ORDER BY stored LIMIT ?)",
+                (max(1, count // 10),))
+
+
+class TieredCache(object):
+    """
+    An LRUCache in front of a SQLiteCache: hot responses are served from
+    memory, and cold ones from disk without a network round trip.
+
+    memory: an LRUCache, or another cache with lookup() and put().
+    disk: a SQLiteCache, or another cache with lookup() and put().
+    ttl: optional default seconds a response stays fresh.
+    """
+    def __init__(self, memory, disk, ttl=None):
+        self.memory = memory
+        self.disk = disk
+        self.ttl = ttl
+
+    def lookup(self, url, stale=False):
+        entry = self.memory.lookup(url, stale)
+        if entry is None:
+            entry = self.disk.lookup(url, stale)
+            if entry is not None:
+                self.memory.put(url, entry)
+        return entry
+
+    def get(self, url):
+        """The response for url, or None if missing, expired or an error."""
+        entry = self.lookup(url)
+        return entry.data if entry is not None and entry.status is None else None
+
+    def put(self, url, entry):
+        self.disk.put(url, entry)
+        self.memory.put(url, entry)
+
+    def set(self, url, data, ttl=None, etag=None, last_modified=None,
+            status=None, headers=None):
+        self.put(url, CacheEntry(data, _expires(ttl if ttl is not None else self.ttl),
+                                 etag, last_modified, status, headers))
+
+    def delete(self, url):
+        self.memory.delete(url)
+        self.disk.delete(url)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+
+class FileCache(object):
+    """
+    An on-disk response cache keeping each response in a file of its own,
+    safe to share between threads and processes. Responses are returned
+    memory-mapped (as mmap objects, which parsers take like bytes; use
+    bytes() for a copy), so a large one is paged in from disk as it's read
+    rather than copied into memory. A Scraper with this cache streams
+    responses straight to disk.
+
+    directory: where the files are kept; created if missing.
+    ttl: optional default seconds a response stays fresh. Expired
+         responses with an ETag or Last-Modified date are kept until
+         purge(), so they can be revalidated.
+    """
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        """The path of url's files, less the .body and .meta suffixes."""
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.meta'))
+
+    def lookup(self, url, stale=False):
+        """
+        Return the CacheEntry for url, or None if missing or expired
+        (unless stale is true).
+        """
+        path = self._path(url)
+        try:
+            with open(path + '.meta', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                # the body is renamed into place before its metadata, so
+                # check they belong together
+                if meta['url'] != url or os.fstat(f.fileno()).st_ino != meta['inode']:
+                    return None
+                data = _map(f, meta['size'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # metadata from before headers were stored has none
+        entry = CacheEntry(data, meta['expires'], meta['etag'],
+                           meta['last_modified'], meta['status'],
+                           meta.get('headers'))
+        if entry.expired() and not stale:
+            if not entry.revalidation_headers():
+                self.delete(url)
+            return None
+        return entry
+
+    def get(self, url):
+        """The response for url, or None if missing, expired or an error."""
+        entry = self.lookup(url)
+        return entry.data if entry is not None and entry.status is None else None
+
+    def put(self, url, entry):
+        self._write(url, (entry.data,), entry)
+
+    def set(self, url, data, ttl=None, etag=None, last_modified=None,
+            status=None, headers=None):
+        self.put(url, CacheEntry(data, _expires(ttl if ttl is not None else self.ttl),
+                                 etag, last_modified, status, headers))
+
+    def set_stream(self, url, chunks, ttl=None, etag=None, last_modified=None):
+        """
+        Like set(), but the response is written to disk a chunk at a time
+        as the iterable chunks yields them. Returns the stored response,
+        memory-mapped. If chunks raises, nothing is stored.
+        """
+        return self._write(url, chunks, CacheEntry(
+            None, _expires(ttl if ttl is not None else self.ttl), etag, last_modified))
+
+    def _write(self, url, chunks, entry):
+        path = self._path(url)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                size = 0
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                data = _map(f, size)
+                inode = os.fstat(f.fileno()).st_ino
+            os.replace(temp_path, path + '.body')
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        _write_atomically(path + '.meta', json.dumps({
+            'url': url, 'size': size, 'inode': inode, 'expires': entry.expires,
+            'etag': entry.etag, 'last_modified': entry.last_modified,
+            'status': entry.status, 'headers': entry.headers}).encode('utf-8'))
+        return data
+
+    def delete(self, url):
+        path = self._path(url)
+        for suffix in ('.meta', '.body'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def purge(self):
+        """Delete every expired response."""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.meta'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if meta.get('expires') is not None and meta['expires'] <= now:
+                self.delete(meta['url'])
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(('.meta', '.body', '.tmp')):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+def _map(f, size):
+    """The first size bytes of file object f, memory-mapped."""
+    if os.fstat(f.fileno()).st_size != size:
+        raise ValueError("%s isn't %d bytes long" % (f.name, size))
+    # empty files can't be mapped
+    if not size:
+        return b''
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+
+def _write_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def parser_key(parser):
+    """
+    The name parsed responses are cached under for parser: its cache_key
+    attribute if it has one, and otherwise its module and qualified name.
+    Returns None for parsers without a name to tell them apart by, e.g.
+    lambdas, nested functions, partials and bound methods.
+    """
+    key = getattr(parser, 'cache_key', None)
+    if key is not None:
+        return str(key)
+
+    if not (inspect.isfunction(parser) or inspect.isclass(parser) or
+            (inspect.isbuiltin(parser) and
+             inspect.ismodule(getattr(parser, '__self__', None)))):
+        return None
+    qualname = getattr(parser, '__qualname__', '')
+    if '<' in qualname:  # <lambda>, <locals>
+        return None
+    return "%s.%s" % (parser.__module__, qualname)
+
+
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class ParsedCache(object):
+    """
+    A cache of parsed responses, so that hits on hot responses skip the
+    parser. Pass one to a client as parsed_cache, alongside its cache;
+    it's only used if the client has a parser.
+
+    Parsed responses are cached by cache url and parser, which is known
+    by parser_key(): set a cache_key attribute on your parser, e.g. with a
+    version number, to tell apart parsers with the same name, or to
+    invalidate what's cached when a parser's output changes. Results of a
+    parser without a key (e.g. a lambda) are kept in memory only, under
+    the parser itself.
+
+    max_entries: the most parsed responses kept in memory; the least
+                 recently used go first.
+    ttl: optional seconds a parsed response is used for. Clients using
+         one of the caches in bottlenose.cache as their response cache
+         also expire each parsed response with the response it was parsed
+         from; with other caches, keep this no longer than theirs, as
+         while a parsed response is fresh the response isn't looked at.
+    disk: optional SQLiteCache (or another cache with lookup() and put())
+          to also keep parsed responses in, serialized, where other
+          processes and later runs can find them. Only use a database you
+          trust, since loading pickles can run arbitrary code.
+    dumps, loads: functions to serialize parsed responses to bytes and
+                  back for disk; pickle by default. Responses that can't
+                  be serialized (e.g. lxml trees with pickle) are just kept
+                  in memory.
+    """
+    def __init__(self, max_entries=1024, ttl=None, disk=None, dumps=_dumps,
+                 loads=pickle.loads):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self.dumps = dumps
+        self.loads = loads
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # parsed responses may not survive pickling, or be keyed by
+        # parsers that can't be pickled; copies start with an empty memory
+        state = self.__dict__.copy()
+        del state['_entries'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, parser, url):
+        """
+        Return a CacheEntry whose data is parser's result for url, or None
+        if missing or expired.
+        """
+        key = self._key(parser, url)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not entry.expired():
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+
+        if self.disk is None or not isinstance(key, str):
+            return None
+        disk_entry = self.disk.lookup(key)
+        if disk_entry is None:
+            return None
+        try:
+            entry = CacheEntry(self.loads(disk_entry.data), disk_entry.expires)
+        except Exception as e:
+            log.debug("Can't load parsed response for %s: %r" % (url, e))
+            self.disk.delete(key)
+            return None
+
+        self._put(key, entry)
+        return entry
+
+    def set(self, parser, url, value, ttl=None, expires=None):
+        """
+        Cache value as parser's result for url, for ttl seconds (by
+        default, the cache's ttl), and no later than the time.time()
+        expires, if given.
+        """
+        key = self._key(parser, url)
+        if key is None:
+            return
+        entry_expires = _expires(ttl if ttl is not None else self.ttl)
+        if expires is not None:
+            entry_expires = min(entry_expires or expires, expires)
+        entry = CacheEntry(value, entry_expires)
+        self._put(key, entry)
+
+        if self.disk is None or not isinstance(key, str):
+            return
+        try:
+            data = self.dumps(value)
+        except Exception as e:
+            log.debug("Can't serialize parsed response for %s: %r" % (url, e))
+            return
+        self.disk.put(key, CacheEntry(data, entry.expires))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def _key(self, parser, url):
+        """
+        The key parser's result for url is cached under: a string, by
+        parser_key(), or else (parser, url), or None if parser can't be
+        hashed.
+        """
+        name = parser_key(parser)
+        if name is not None:
+            return name + " " + url
+        try:
+            hash(parser)
+        except TypeError:
+            return None
+        # holding on to parser, so its id isn't reused by another one
+        return (parser, url)
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+__all__ = ["CacheEntry", "FileCache", "LRUCache", "ParsedCache", "SQLiteCache",
+           "TieredCache", "parser_key"]
@@ -0,0 +1,270 @@
+"""
+Run a file of queries against Amazon, Goodreads or any URL, across a pool
+of processes that share one rate limit and one cache:
+
+    bottlenose amazon queries.jsonl -o results.jsonl --cache amazon.db
+    bottlenose goodreads isbns.csv -o results.jsonl --operation book/isbn_to_id
+
+Each line of a JSONL file (or row of a CSV file, with a header) is one
+query: its keys are the query's parameters, plus _operation, the operation
+to call (defaulting to --operation), and optionally _id, which identifies
+the query in the output (defaulting to its line number).
+
+Results are written to the output file as they complete, in no particular
+order, one JSON object per line with the query's id, operation and params,
+and either its response or an error. Run again with --resume after a crash
+or an interruption to skip the queries that have already succeeded.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from bottlenose.amazon import Amazon
+from bottlenose.cache import SQLiteCache
+from bottlenose.goodreads import Goodreads
+from bottlenose.ratelimit import SharedTokenBucket
+from bottlenose.retry import RetryPolicy
+from bottlenose.scraper import Scraper
+
+
+log = logging.getLogger(__name__)
+
+SERVICES = ("amazon", "goodreads", "scraper")
+
+# each service's published query limit; arbitrary sites have none
+DEFAULT_QPS = {'amazon': 1.0, 'goodreads': 1.0, 'scraper': None}
+
+ID_KEY = '_id'
+OPERATION_KEY = '_operation'
+
+
+def read_queries(f, format, operation=None):
+    """
+    Yield an (id, operation, params) tuple for each query in f, a JSONL or
+    CSV file (format 'jsonl' or 'csv'). Empty CSV cells are left out of
+    params.
+    """
+    if format == 'csv':
+        records = ({key: value for key, value in row.items() if value}
+                   for row in csv.DictReader(f))
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+
+    for number, record in enumerate(records, 1):
+        query_id = record.pop(ID_KEY, number)
+        query_operation = record.pop(OPERATION_KEY, operation)
+        if not query_operation:
+            raise ValueError("Query %s has no %s and there's no --operation" %
+                             (query_id, OPERATION_KEY))
+        yield query_id, query_operation, record
+
+
+def completed_ids(path):
+    """
+    The ids of the queries that succeeded according to the output file at
+    path. Trims any partial line a crash left at its end, so that it can be
+    appended to.
+    """
+    ids = set()
+    if not os.path.exists(path):
+        return ids
+
+    with open(path, 'rb+') as f:
+        size = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                result = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            size += len(line)
+            if 'error' not in result:
+                ids.add(result['id'])
+        f.truncate(size)
+    return ids
+
+
+def make_client(options):
+    """A client for options.service, configured from the command line."""
+    rate_limiter = None
+    if options.qps:
+        rate_limiter = SharedTokenBucket(options.rate_file, options.qps,
+                                         options.burst)
+    cache = None
+    if options.cache:
+        cache = SQLiteCache(options.cache, ttl=options.ttl)
+
+    # every process makes one call at a time, so there's nothing to coalesce
+    kwargs = dict(timeout=options.timeout, rate_limiter=rate_limiter,
+                  cache=cache, single_flight=False,
+                  retry_policy=RetryPolicy(max_retries=options.max_retries))
+
+    if options.service == 'amazon':
+        return Amazon(options.aws_access_key_id, options.aws_secret_access_key,
+                      options.associate_tag, region=options.region, **kwargs)
+    if options.service == 'goodreads':
+        return Goodreads(options.goodreads_api_key, **kwargs)
+    return Scraper(**kwargs)
+
+
+# each worker process's client, made once by _init_worker()
+_client = None
+
+
+def _init_worker(options):
+    global _client
+    _client = make_client(options)
+
+
+def _run_query(query):
+    """Call the API for query, in a worker process, returning its result."""
+    query_id, operation, params = query
+    result = {'id': query_id, 'operation': operation, 'params': params}
+    try:
+        response_text = _client._invoke(operation, dict(params),
+                                        _client._call_text)
+    except Exception as e:
+        result['error'] = "%s: %s" % (e.__class__.__name__, e)
+    else:
+        result['response'] = response_text.decode('utf-8', 'replace')
+    return result
+
+
+def run(options, queries, output):
+    """
+    Run queries across options.processes processes, writing each result to
+    output as soon as it arrives. Returns the number of queries that
+    succeeded and failed.
+    """
+    counts = {'succeeded': 0, 'failed': 0}
+    # enough queued that no process waits for work, without reading the
+    # whole input into memory
+    max_pending = options.processes * 4
+
+    def write_done(pending):
+        """Wait for a result and write it; returns the rest of pending."""
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            if 'error' in result:
+                log.warning("Query %s failed: %s" % (result['id'], result['error']))
+                counts['failed'] += 1
+            else:
+                counts['succeeded'] += 1
+        # so that a crash loses at most the calls still in flight
+        output.flush()
+        return pending
+
+    with ProcessPoolExecutor(options.processes, initializer=_init_worker,
+                             initargs=(options,)) as executor:
+        pending = set()
+        for query in queries:
+            if len(pending) >= max_pending:
+                pending = write_done(pending)
+            pending.add(executor.submit(_run_query, query))
+
+        while pending:
+            pending = write_done(pending)
+
+    return counts['succeeded'], counts['failed']
+
+
+def parse_args(args=None):
+    arg_parser = argparse.ArgumentParser(
+        prog="bottlenose", description="\n\n".join(__doc__.split("\n\n")[:2]),
+        epilog=__doc__.split("\n\n", 2)[2],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("service", choices=SERVICES)
+    arg_parser.add_argument("input", help="JSONL or CSV file of queries, or - for stdin")
+    arg_parser.add_argument("-o", "--output", required=True,
+                            help="JSONL file to write the results to")
+    arg_parser.add_argument("--format", choices=("jsonl", "csv"),
+                            help="format of input; by default, csv if its "
+                                 "name ends in .csv and jsonl otherwise")
+    arg_parser.add_argument("--operation",
+                            help="operation for queries without %s" % OPERATION_KEY)
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="append to output, skipping the queries that "
+                                 "already succeeded there")
+    arg_parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                            help="worker processes (default: one per CPU)")
+    arg_parser.add_argument("--qps", type=float,
+                            help="queries per second across all processes "
+                                 "(default: 1 for amazon and goodreads, "
+                                 "unlimited for scraper; 0 for unlimited)")
+    arg_parser.add_argument("--burst", type=int, default=1,
+                            help="queries that may be made at once after a pause")
+    arg_parser.add_argument("--rate-file",
+                            help="file holding the shared rate limit's state; "
+                                 "pass the same one to concurrent runs that "
+                                 "use the same key (default: a temporary file)")
+    arg_parser.add_argument("--cache", help="SQLite file to cache responses in")
+    arg_parser.add_argument("--ttl", type=float,
+                            help="seconds cached responses stay fresh")
+    arg_parser.add_argument("--timeout", type=float, help="seconds per request")
+    arg_parser.add_argument("--max-retries", type=int, default=5,
+                            help="retries of throttled and failed requests")
+    arg_parser.add_argument("--region", default="US", help="Amazon region")
+    arg_parser.add_argument("--aws-access-key-id",
+                            help="default: $AWS_ACCESS_KEY_ID")
+    arg_parser.add_argument("--aws-secret-access-key",
+                            help="default: $AWS_SECRET_ACCESS_KEY")
+    arg_parser.add_argument("--associate-tag", help="default: $AWS_ASSOCIATE_TAG")
+    arg_parser.add_argument("--goodreads-api-key",
+                            default=os.environ.get('GOODREADS_API_KEY'),
+                            help="default: $GOODREADS_API_KEY")
+    arg_parser.add_argument("-v", "--verbose", action="store_true")
+    return arg_parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    if options.qps is None:
+        options.qps = DEFAULT_QPS[options.service]
+    if options.format is None:
+        options.format = 'csv' if options.input.endswith('.csv') else 'jsonl'
+
+    temporary_rate_file = None
+    if options.qps and not options.rate_file:
+        fd, temporary_rate_file = tempfile.mkstemp(prefix="bottlenose-", suffix=".bucket")
+        os.close(fd)
+        options.rate_file = temporary_rate_file
+
+    skip = completed_ids(options.output) if options.resume else set()
+    if skip:
+        log.info("Skipping %d queries that already succeeded" % len(skip))
+
+    if options.input == '-':
+        input_file = sys.stdin
+    else:
+        input_file = open(options.input, newline='', encoding='utf-8')
+
+    try:
+        queries = (query for query in
+                   read_queries(input_file, options.format, options.operation)
+                   if query[0] not in skip)
+        with open(options.output, 'a' if options.resume else 'w',
+                  encoding='utf-8') as output:
+            succeeded, failed = run(options, queries, output)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if temporary_rate_file:
+            os.remove(temporary_rate_file)
+
+    log.info("%d queries succeeded, %d failed" % (succeeded, failed))
+    return 1 if failed else 0
+
+
+__all__ = ["completed_ids", "main", "make_client", "read_queries", "run"]
@@ -1,50 +1,71 @@
+import math
+import re
+
 from bottlenose import Call, quote_query
+from bottlenose.aio import AsyncCall
 
 
 GOODREADS_DOMAIN = "www.goodreads.com"
 
+# paged lists look like <reviews start="1" end="20" total="95">, except
+# search results, which use <results-start> and friends instead
+LIST_ATTRIBUTES = re.compile(
+    br'<[\w-]+\s[^>]*\bstart="(\d+)"[^>]*\bend="(\d+)"[^>]*\btotal="(\d+)"')
+SEARCH_ELEMENTS = re.compile(
+    br'<results-start>(\d+)</results-start>\s*'
+    br'<results-end>(\d+)</results-end>\s*'
+    br'<total-results>(\d+)</total-results>')
+
 
 class GoodreadsCall(Call):
     """
     A call to the Goodreads API.
     """
+    stream_tags = ('book', 'review')
+    page_param = 'page'
+
     def __init__(self, goodreads_api_key=None, operation=None,
                  timeout=None, max_qps=None, parser=None,
                  cache_reader=None, cache_writer=None,
-                 error_handler=None, max_retries=5, last_query_time=None):
+                 error_handler=None, max_retries=5, last_query_time=None,
+                 rate_limiter=None, transport=None, cache=None,
+                 single_flight=None, retry_policy=None, metrics=None,
+                 parsed_cache=None, stale_while_revalidate=None,
+                 negative_ttl=None, deadline=None):
         super(GoodreadsCall, self).__init__(operation, timeout, max_qps, parser,
                                             cache_reader, cache_writer,
-                                            error_handler, max_retries, last_query_time)
+                                            error_handler, max_retries,
+                                            last_query_time, rate_limiter,
+                                            transport, cache, single_flight,
+                                            retry_policy, metrics, parsed_cache,
+                                            stale_while_revalidate, negative_ttl,
+                                            deadline)
 
         self.goodreads_api_key = goodreads_api_key
 
-    def __getattr__(self, k):
-        try:
-            return super(GoodreadsCall, self).__getattr__(self, k)
-        except:
-            return GoodreadsCall(self.goodreads_api_key,
-                                 operation=k, timeout=self.timeout,
-                                 max_qps=self.max_qps, parser=self.parser,
-                                 cache_reader=self.cache_reader,
-                                 cache_writer=self.cache_writer,
-                                 error_handler=self.error_handler,
-                                 max_retries=self.max_retries,
-                                 last_query_time=self._last_query_time)
-
-    def api_url(self, **kwargs):
-        """The URL for making the given query against the API."""
+    def _api_url(self, operation, kwargs):
         query = kwargs
         quoted_strings = quote_query(query)
 
-        return ("https://" + GOODREADS_DOMAIN + "/" + self.operation +
+        return ("https://" + GOODREADS_DOMAIN + "/" + operation +
                 "/index.xml?" + quoted_strings + "&key=%s" % self.goodreads_api_key)
 
-    def cache_url(self, **kwargs):
-        """A simplified URL to be used for caching the given query."""
+    def _total_pages(self, response_text):
+        match = (LIST_ATTRIBUTES.search(response_text) or
+                 SEARCH_ELEMENTS.search(response_text))
+        if not match:
+            return None
+
+        start, end, total = (int(group) for group in match.groups())
+        if end < start:
+            return 1
+        return int(math.ceil(total / (end - start + 1)))
+
+    def _cache_url(self, operation, kwargs):
         query = kwargs
         quoted_strings = quote_query(query)
 
-        return ("https://" + GOODREADS_DOMAIN + "/" + self.operation +
+        return ("https://" + GOODREADS_DOMAIN + "/" + operation +
                 "/index.xml?" + quoted_strings)
 
 
@@ -52,7 +73,11 @@ class Goodreads(GoodreadsCall):
     def __init__(self, goodreads_api_key=None, operation=None,
                  timeout=None, max_qps=None, parser=None,
                  cache_reader=None, cache_writer=None, error_handler=None,
-                 max_retries=5):
+                 max_retries=5, rate_limiter=None, transport=None,
+                 cache=None, single_flight=None, retry_policy=None,
+                 metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None):
         """
         Create an Goodreads API object.
 
@@ -61,6 +86,44 @@ class Goodreads(GoodreadsCall):
         GoodreadsCall.__init__(self, goodreads_api_key, operation=operation,
                                timeout=timeout, max_qps=max_qps, parser=parser,
                                cache_reader=cache_reader, cache_writer=cache_writer,
-                               error_handler=error_handler, max_retries=max_retries)
+                               error_handler=error_handler, max_retries=max_retries,
+                               rate_limiter=rate_limiter, transport=transport,
+                               cache=cache, single_flight=single_flight,
+                               retry_policy=retry_policy, metrics=metrics,
+                               parsed_cache=parsed_cache,
+                               stale_while_revalidate=stale_while_revalidate,
+                               negative_ttl=negative_ttl, deadline=deadline)
+
+
+class AsyncGoodreadsCall(AsyncCall, GoodreadsCall):
+    """
+    An awaitable call to the Goodreads API.
+    """
+
+
+class AsyncGoodreads(AsyncGoodreadsCall):
+    def __init__(self, goodreads_api_key=None, operation=None,
+                 timeout=None, max_qps=None, parser=None,
+                 cache_reader=None, cache_writer=None, error_handler=None,
+                 max_retries=5, rate_limiter=None, transport=None,
+                 cache=None, single_flight=None, retry_policy=None,
+                 metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None):
+        """
+        Create an awaitable Goodreads API object. Takes the same arguments
+        as Goodreads; every operation returns a coroutine.
+        """
+        AsyncGoodreadsCall.__init__(self, goodreads_api_key, operation=operation,
+                                    timeout=timeout, max_qps=max_qps, parser=parser,
+                                    cache_reader=cache_reader, cache_writer=cache_writer,
+                                    error_handler=error_handler, max_retries=max_retries,
+                                    rate_limiter=rate_limiter, transport=transport,
+                                    cache=cache, single_flight=single_flight,
+                                    retry_policy=retry_policy, metrics=metrics,
+                                    parsed_cache=parsed_cache,
+                                    stale_while_revalidate=stale_while_revalidate,
+                                    negative_ttl=negative_ttl,
+                                    deadline=deadline)
 
-__all__ = ["Goodreads"]
+__all__ = ["Goodreads", "AsyncGoodreads"]
@@ -0,0 +1,155 @@
+import bisect
+import threading
+
+from urllib.error import HTTPError, URLError
+
+
+class Histogram(object):
+    """
+    The distribution of a series of observed values, such as seconds,
+    kept as counts in exponentially growing buckets so that its memory
+    use doesn't grow with the number of observations. Quantiles are
+    estimated from the buckets, to within a factor of two.
+
+    Not thread-safe on its own; Metrics locks around it.
+    """
+    # 10 microseconds up to about a minute and a half
+    BOUNDS = tuple(1e-5 * 2 ** i for i in range(24))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate the value below which a fraction q of observations fall."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                upper = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+                return max(self.min, min(upper, self.max))
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics(object):
+    """
+    Collects timings and counts from every client it's passed to as
+    metrics, by operation. Safe to share between threads and clients.
+
+    Clients time these stages of a call, in seconds:
+        cache: looking the response up in the cache
+        sign: building (for Amazon, signing) the request URL
+        throttle: waiting for the rate limiter
+        network: from sending the request to the response headers
+                 arriving, including any retries
+        download: reading the response body
+        decode: decompressing it
+        parse: running parser over it
+        cache_write: writing it to the cache
+
+    and count these events:
+        cache_hit, cache_miss: cache lookups
+        parsed_hit, parsed_miss: parsed cache lookups
+        stale_hit: expired cached responses returned while being refreshed
+        negative_hit: errors raised again from the cache
+        not_modified: expired cached responses revalidated with a 304
+        retries: requests made again after an error
+        bytes_received: response bytes read off the wire
+        bytes_decoded: response bytes after decompression
+        errors.<class>: failed requests, e.g. errors.HTTPError.503 or
+                        errors.URLError.ConnectionRefusedError
+
+    To send these somewhere else, such as statsd, pass clients any object
+    with the same observe() and increment() methods instead.
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def observe(self, operation, stage, value):
+        """Record that stage of a call to operation took value seconds."""
+        key = (operation, stage)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, operation, name, amount=1):
+        """Add amount to the counter name for operation."""
+        key = (operation, name)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        """
+        The metrics so far, as a dictionary of operation to a dictionary
+        with a 'stages' dictionary of each stage's count, sum, min, max,
+        mean, p50, p90 and p99, and a 'counters' dictionary.
+        """
+        result = {}
+        with self._lock:
+            for (operation, stage), histogram in self._histograms.items():
+                operation_metrics = result.setdefault(
+                    operation, {'stages': {}, 'counters': {}})
+                operation_metrics['stages'][stage] = histogram.snapshot()
+            for (operation, name), count in self._counters.items():
+                operation_metrics = result.setdefault(
+                    operation, {'stages': {}, 'counters': {}})
+                operation_metrics['counters'][name] = count
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def error_name(exception):
+    """The counter name for a failed request, e.g. errors.HTTPError.503."""
+    if isinstance(exception, HTTPError):
+        return 'errors.HTTPError.%d' % exception.code
+    if isinstance(exception, URLError) and isinstance(exception.reason, BaseException):
+        return 'errors.URLError.%s' % exception.reason.__class__.__name__
+    return 'errors.%s' % exception.__class__.__name__
+
+
+__all__ = ["Histogram", "Metrics"]
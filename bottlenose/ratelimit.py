@@ -0,0 +1,444 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def _takes_max_wait(cls):
+    try:
+        parameters = inspect.signature(cls.reserve).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(parameter.name == 'max_wait' or
+               parameter.kind == parameter.VAR_KEYWORD
+               for parameter in parameters)
+
+
+def _reserve_within(rate_limiter, max_wait=None):
+    """
+    rate_limiter.reserve(), passing max_wait on to rate limiters whose
+    reserve() takes it. Others take a token and return the wait, however
+    long, so callers must still check it against max_wait.
+    """
+    if max_wait is None or not _takes_max_wait(type(rate_limiter)):
+        return rate_limiter.reserve()
+    return rate_limiter.reserve(max_wait=max_wait)
+
+
+# the priority class of the call being made, from its _priority keyword
+call_priority = contextvars.ContextVar('call_priority', default=None)
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter, safe to share between threads.
+
+    rate: tokens added per second, i.e. the sustained queries per second.
+    burst: the most tokens the bucket holds, i.e. how many queries may be
+           made back to back after a quiet period. Defaults to 1, which
+           spaces every query 1/rate seconds apart.
+
+    Callers that find the bucket empty reserve a future token rather than
+    polling for one, so each waits exactly until its own turn.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+
+        self._state = (burst, time.time())
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _take(self, state, now, max_wait=None):
+        """
+        Take one token. Returns the new state and the wait until it's ours;
+        if that's over max_wait, the token isn't taken and state is returned
+        unchanged.
+        """
+        tokens, updated = state
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        wait_time = -tokens / self.rate if tokens < 0 else 0
+        if max_wait is not None and wait_time > max_wait:
+            return state, wait_time
+        return (tokens, now), wait_time
+
+    def reserve(self, max_wait=None):
+        """
+        Take a token, returning the number of seconds the caller must wait
+        before using it.
+
+        max_wait: if given, and the wait would be longer, no token is taken
+                  (and the caller shouldn't make its call).
+        """
+        with self._lock:
+            self._state, wait_time = self._take(self._state, time.time(), max_wait)
+        return wait_time
+
+    def acquire(self):
+        """Take a token, sleeping until it can be used."""
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    A TokenBucket that learns the rate the API will sustain: it speeds up
+    steadily while calls succeed, and halves its rate when the API
+    throttles us (additive increase, multiplicative decrease, as TCP
+    does). The current rate is in rate.
+
+    Clients report each call's outcome through record_success() and
+    record_throttle(), so share one between clients using the same key.
+
+    rate: queries per second to start at.
+    min_rate: the rate is never cut below this.
+    max_rate: optional cap on the rate.
+    increase: queries per second added per second of successful calls.
+    decrease: what the rate is multiplied by when we're throttled.
+    cooldown: seconds after a cut in which further throttles are ignored,
+              since calls already in flight were sent at the old rate.
+    burst: as for TokenBucket.
+    """
+    def __init__(self, rate=1.0, min_rate=0.1, max_rate=None, increase=0.05,
+                 decrease=0.5, cooldown=1.0, burst=1):
+        super(AdaptiveRateLimiter, self).__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self._decreased = 0
+
+    def record_success(self):
+        with self._lock:
+            # spread over the calls made in a second at the current rate
+            rate = self.rate + self.increase / self.rate
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            self.rate = rate
+
+    def record_throttle(self):
+        with self._lock:
+            now = time.time()
+            if now - self._decreased < self.cooldown:
+                return
+            self._decreased = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            log.debug('Throttled; rate is now %.3f/s' % self.rate)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A TokenBucket whose tokens are kept in a file, so every thread and
+    process on the machine that opens the same path draws from one budget.
+
+    path: file holding the bucket's state; created if missing. Use one
+          path per key whose rate you need to respect.
+    rate, burst: as for TokenBucket. Every user of path should pass the
+                 same values.
+
+    Requires fcntl (i.e. a Unix-like OS).
+    """
+    STATE = struct.Struct('dd')
+
+    def __init__(self, path, rate, burst=1):
+        if fcntl is None:
+            raise RuntimeError("SharedTokenBucket requires fcntl")
+
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def __getstate__(self):
+        # every process opens the file for itself
+        state = super(SharedTokenBucket, self).__getstate__()
+        state['_pid'] = state['_fd'] = state['_map'] = None
+        return state
+
+    def _open(self):
+        # flock() locks are shared by forked children that inherit the
+        # descriptor, so every process needs its own
+        if self._pid == os.getpid():
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self.STATE.size:
+                os.ftruncate(fd, self.STATE.size)
+                os.pwrite(fd, self.STATE.pack(self.burst, time.time()), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.STATE.size)
+        self._pid = os.getpid()
+
+    def reserve(self, max_wait=None):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = self.STATE.unpack_from(self._map)
+                state, wait_time = self._take(state, time.time(), max_wait)
+                self.STATE.pack_into(self._map, 0, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait_time
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._map.close()
+                os.close(self._fd)
+            self._pid = self._fd = self._map = None
+
+
+class _Turn(object):
+    """A call waiting for its turn at a PriorityScheduler."""
+    __slots__ = ('priority', 'event', 'loop', 'future')
+
+    def __init__(self, priority, loop=None):
+        self.priority = priority
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+
+class PriorityScheduler(object):
+    """
+    Shares a rate limiter between calls of different priority classes,
+    e.g. interactive lookups and bulk catalog refreshes made through the
+    same client. Pass it as a client's rate_limiter, and give calls a
+    class with the _priority keyword:
+
+        amazon.ItemLookup(ItemId="0316067938", _priority='batch')
+
+    Calls take turns at the rate limiter, one token at a time, rather than
+    reserving tokens in the order they arrive, so a backlog of one class
+    doesn't hold up the others. When several classes are waiting, turns
+    are shared out in proportion to their weights (weighted fair
+    queueing): with the default weights, interactive calls go ten times
+    as often as batch calls, but batch calls are never starved.
+
+    rate_limiter: the TokenBucket (or similar) whose tokens are shared.
+    weights: dict of each priority class's share of the turns.
+    default: the class of calls without a _priority.
+    """
+    def __init__(self, rate_limiter, weights=None, default='interactive'):
+        if weights is None:
+            weights = {'interactive': 10, 'batch': 1}
+        if default not in weights:
+            raise ValueError("Unknown default priority %r" % (default,))
+
+        self.rate_limiter = rate_limiter
+        self.weights = weights
+        self.default = default
+
+        self._queues = {priority: deque() for priority in weights}
+        # each class's virtual finish time: how far through its share of
+        # turns it is
+        self._finish = {priority: 0.0 for priority in weights}
+        self._virtual_time = 0.0
+        self._busy = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # calls waiting for a turn are left behind
+        state = self.__dict__.copy()
+        del state['_queues'], state['_busy'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._queues = {priority: deque() for priority in self.weights}
+        self._busy = False
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.rate_limiter.rate
+
+    def record_success(self):
+        record = getattr(self.rate_limiter, 'record_success', None)
+        if record:
+            record()
+
+    def record_throttle(self):
+        record = getattr(self.rate_limiter, 'record_throttle', None)
+        if record:
+            record()
+
+    def queue_depths(self):
+        """The number of calls waiting for a turn, by priority class."""
+        with self._lock:
+            return {priority: len(queue) for priority, queue in self._queues.items()}
+
+    def _priority(self, priority):
+        if priority is None:
+            priority = call_priority.get()
+        if priority is None:
+            return self.default
+        if priority not in self.weights:
+            raise ValueError("Unknown priority %r" % (priority,))
+        return priority
+
+    def _serve(self, priority):
+        """Account for a turn given to priority. Call with the lock held."""
+        self._virtual_time = self._finish[priority]
+        self._finish[priority] += 1.0 / self.weights[priority]
+
+    def _enqueue(self, turn):
+        """
+        Queue turn, or return True if the scheduler was idle, in which case
+        the turn is taken at once.
+        """
+        priority = turn.priority
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                self._finish[priority] = max(self._finish[priority], self._virtual_time)
+                self._serve(priority)
+                return True
+
+            queue = self._queues[priority]
+            if not queue:
+                # a class that's been idle doesn't save up turns
+                self._finish[priority] = max(self._finish[priority], self._virtual_time)
+            queue.append(turn)
+            return False
+
+    def _release(self):
+        """Pass the turn on to the next waiting call, if any."""
+        with self._lock:
+            waiting = [priority for priority, queue in self._queues.items() if queue]
+            if not waiting:
+                self._busy = False
+                return
+            priority = min(waiting, key=self._finish.__getitem__)
+            turn = self._queues[priority].popleft()
+            self._serve(priority)
+
+        if turn.loop is None:
+            turn.event.set()
+        else:
+            turn.loop.call_soon_threadsafe(self._wake, turn)
+
+    def _wake(self, turn):
+        if turn.future.done():
+            # cancelled while waiting; let someone else go
+            self._release()
+        else:
+            turn.future.set_result(None)
+
+    def _withdraw(self, turn):
+        """
+        Take turn out of its queue, if it's still there. Returns False if
+        it has already been handed the turn.
+        """
+        with self._lock:
+            queue = self._queues[turn.priority]
+            if turn in queue:
+                queue.remove(turn)
+                return True
+            return False
+
+    def _reserve_token(self, max_wait):
+        return _reserve_within(self.rate_limiter, max_wait)
+
+    def reserve(self, priority=None, max_wait=None):
+        """
+        Wait for a turn and then for a token from the rate limiter. Returns
+        0, as the caller needn't wait any longer.
+
+        priority: the class of the call; defaults to that of the call being
+                  made, or default.
+        max_wait: if given, and the turn and the token won't both come
+                  within it, gives up without a token and returns a wait
+                  over max_wait.
+        """
+        start = time.monotonic()
+        turn = _Turn(self._priority(priority))
+        if not self._enqueue(turn) and not turn.event.wait(max_wait):
+            if self._withdraw(turn):
+                return float('inf')
+
+        # the turn is held until the token can be used, so that a call
+        # of a higher priority that arrives meanwhile goes next
+        try:
+            if max_wait is not None:
+                max_wait -= time.monotonic() - start
+            wait_time = self._reserve_token(max_wait)
+            if max_wait is not None and wait_time > max_wait:
+                return float('inf')
+            if wait_time > 0:
+                time.sleep(wait_time)
+        finally:
+            self._release()
+        return 0
+
+    def acquire(self, priority=None):
+        self.reserve(priority)
+
+    async def reserve_async(self, priority=None, max_wait=None):
+        """Like reserve(), but waits without blocking the event loop."""
+        start = time.monotonic()
+        turn = _Turn(self._priority(priority), asyncio.get_event_loop())
+        if not self._enqueue(turn):
+            try:
+                await asyncio.wait_for(turn.future, max_wait)
+            except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+                # if it was already handed the turn, pass it on; if the
+                # handing over was cut short, _wake() does
+                if not self._withdraw(turn) and not turn.future.cancelled():
+                    self._release()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                return float('inf')
+
+        try:
+            if max_wait is not None:
+                max_wait -= time.monotonic() - start
+            wait_time = self._reserve_token(max_wait)
+            if max_wait is not None and wait_time > max_wait:
+                return float('inf')
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+        finally:
+            self._release()
+        return 0
+
+
+__all__ = ["AdaptiveRateLimiter", "PriorityScheduler", "SharedTokenBucket",
+           "TokenBucket", "call_priority"]
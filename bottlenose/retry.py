@@ -0,0 +1,254 @@
+import contextvars
+import random
+import socket
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from http import client
+from urllib import parse
+from urllib.error import HTTPError, URLError
+
+
+# failure classes, as returned by RetryPolicy.classify()
+THROTTLED = 'throttled'
+SERVER_ERROR = 'server_error'
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+
+
+# the time.monotonic() by which the call being made must finish, from its
+# _deadline keyword or its client's deadline
+call_deadline = contextvars.ContextVar('call_deadline', default=None)
+
+
+def time_left():
+    """Seconds until the current call's deadline, or None if it has none."""
+    deadline = call_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def is_throttled(exception):
+    """Whether exception means the API wants us to slow down."""
+    return isinstance(exception, HTTPError) and exception.code in (429, 503)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a host whose circuit is open, i.e. one that
+    has failed repeatedly and hasn't been given another try yet.
+    """
+    def __init__(self, host, retry_in):
+        super(CircuitOpenError, self).__init__(
+            "Circuit open for %s; retry in %.1fs" % (host, retry_in))
+        self.host = host
+        self.retry_in = retry_in
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a call can't finish before its deadline, whether waiting
+    for the rate limiter, between retries or reading the response.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of one host, safe to share between threads.
+
+    After failure_threshold failures in a row the circuit opens, and calls
+    fail fast with CircuitOpenError. Once reset_timeout seconds have passed,
+    a single call is let through as a trial: if it succeeds the circuit
+    closes, and if it fails the circuit stays open for another
+    reset_timeout.
+    """
+    def __init__(self, host, failure_threshold=5, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may be made now."""
+        with self._lock:
+            if self._opened is None:
+                return
+
+            now = time.time()
+            retry_in = self._opened + self.reset_timeout - now
+            if retry_in > 0:
+                raise CircuitOpenError(self.host, retry_in)
+
+            # let this call through as the trial, and keep failing everyone
+            # else fast until it finishes (or another reset_timeout passes)
+            self._opened = now
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened = time.time()
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed API calls are retried and how long to wait first.
+    Safe to share between threads, and between clients.
+
+    Throttling (HTTP 503 and 429), other 5xx errors, timeouts and
+    connection errors are retried; other 4xx errors aren't, since asking
+    again won't help. Waits grow exponentially from base_delay, with full
+    jitter so that many callers don't retry in lockstep, unless the server
+    sent a Retry-After header, which is honored instead.
+
+    Each host (for Amazon, each region's endpoint) has its own circuit
+    breaker, so calls to a host that keeps failing fail fast with
+    CircuitOpenError instead of piling up behind it.
+
+    max_retries: the most retries per call.
+    base_delay: seconds to wait before the first retry.
+    max_delay: cap on the seconds waited before any one retry.
+    throttle_delay: seconds to wait before the first retry of a throttled
+                    call; defaults to base_delay.
+    failure_threshold: failures in a row that open a host's circuit.
+                       None disables circuit breaking.
+    reset_timeout: seconds an open circuit waits before a trial call.
+    """
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30,
+                 throttle_delay=None, failure_threshold=10, reset_timeout=30):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttle_delay = throttle_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def classify(self, exception):
+        """
+        The class of failure exception is, e.g. THROTTLED, or None if
+        retrying won't help.
+        """
+        if is_throttled(exception):
+            return THROTTLED
+        if isinstance(exception, DeadlineExceeded):
+            return None
+        if isinstance(exception, HTTPError):
+            if exception.code >= 500:
+                return SERVER_ERROR
+            return None
+
+        if isinstance(exception, URLError):
+            exception = exception.reason
+        if isinstance(exception, (socket.timeout, TimeoutError)):
+            return TIMEOUT
+        if isinstance(exception, (OSError, client.HTTPException)):
+            return CONNECTION_ERROR
+        return None
+
+    def breaker(self, url):
+        """The CircuitBreaker for url's host, or None if disabled."""
+        if self.failure_threshold is None:
+            return None
+
+        host = parse.urlsplit(url).netloc
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(
+                    host, self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def check(self, url):
+        """Raise CircuitOpenError if url's host shouldn't be called now."""
+        breaker = self.breaker(url)
+        if breaker:
+            breaker.check()
+
+    def record_success(self, url):
+        breaker = self.breaker(url)
+        if breaker:
+            breaker.record_success()
+
+    def record_failure(self, url, attempt, exception):
+        """
+        Note that attempt number attempt at calling url raised exception.
+        Returns the seconds to wait before retrying, or None to give up.
+        """
+        failure = self.classify(exception)
+        breaker = self.breaker(url)
+        if breaker:
+            # a 4xx means the host is up, even if our query was bad
+            if failure is None:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+        if failure is None or attempt > self.max_retries:
+            return None
+        return self.delay(attempt, failure, exception)
+
+    def delay(self, attempt, failure, exception=None):
+        """Seconds to wait before retrying after attempt number attempt."""
+        retry_after = _retry_after(exception)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        base_delay = self.base_delay
+        if failure == THROTTLED and self.throttle_delay is not None:
+            base_delay = self.throttle_delay
+        return random.uniform(0, min(self.max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def _retry_after(exception):
+    """The seconds in an HTTPError's Retry-After header, or None."""
+    headers = getattr(exception, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+__all__ = ["CircuitBreaker", "CircuitOpenError", "DeadlineExceeded", "RetryPolicy",
+           "call_deadline", "is_throttled", "time_left"]
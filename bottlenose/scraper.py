@@ -1,48 +1,348 @@
+import asyncio
+import contextvars
+import functools
+import time
+
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib import parse
+
 from bottlenose import Call
+from bottlenose.aio import AsyncCall
+from bottlenose.api import READ_CHUNK_SIZE
+from bottlenose.ratelimit import TokenBucket
+from bottlenose.retry import DeadlineExceeded, time_left
+from bottlenose.stream import decoded_stream
+
+
+# crawled pages are recorded in metrics under this operation
+CRAWL_OPERATION = 'crawl'
+
+CrawlResult = namedtuple('CrawlResult', ['url', 'response', 'error'])
+CrawlResult.__doc__ = """
+One crawled URL: the (parsed) response, or the exception fetching it
+raised as error.
+"""
+
+
+class ResponseTooLarge(Exception):
+    """Raised when a response is bigger than a Scraper's max_size."""
+    def __init__(self, url, max_size):
+        super(ResponseTooLarge, self).__init__(
+            "Response from %s is over %d bytes" % (url, max_size))
+        self.url = url
+        self.max_size = max_size
+
+
+class CrawlScheduler(object):
+    """
+    Hands out URLs to crawl so that no host has more than per_host of them
+    in flight, reading the URLs lazily. URLs for busy hosts wait in a
+    buffer of at most max_buffered URLs. Not thread-safe; it's driven by
+    a single loop.
+
+    per_host_qps: optional queries per second allowed per host, enforced
+                  with a TokenBucket for each.
+    """
+    def __init__(self, urls, per_host=2, per_host_qps=None, max_buffered=1000):
+        self.per_host = per_host
+        self.per_host_qps = per_host_qps
+        self.max_buffered = max_buffered
+
+        self._urls = iter(urls)
+        self._exhausted = False
+        self._waiting = OrderedDict()
+        self._buffered = 0
+        self._active = defaultdict(int)
+        self._limiters = {}
+
+    def next_url(self):
+        """A URL whose host has a free slot, or None if there isn't one now."""
+        for host, waiting in self._waiting.items():
+            if self._active[host] < self.per_host:
+                url = waiting.popleft()
+                self._buffered -= 1
+                # round robin: this host goes to the back of the line
+                del self._waiting[host]
+                if waiting:
+                    self._waiting[host] = waiting
+                return self._start(host, url)
+
+        while not self._exhausted and self._buffered < self.max_buffered:
+            try:
+                url = next(self._urls)
+            except StopIteration:
+                self._exhausted = True
+                break
+
+            host = parse.urlsplit(url).netloc
+            if self._active[host] < self.per_host:
+                return self._start(host, url)
+            self._waiting.setdefault(host, deque()).append(url)
+            self._buffered += 1
+        return None
+
+    def _start(self, host, url):
+        self._active[host] += 1
+        return url
+
+    def done(self, url):
+        """Free url's slot once it has been crawled."""
+        self._active[parse.urlsplit(url).netloc] -= 1
+
+    def wait_time(self, url):
+        """Take a token for url's host; returns the seconds to wait to use it."""
+        if not self.per_host_qps:
+            return 0
+
+        host = parse.urlsplit(url).netloc
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = self._limiters[host] = TokenBucket(self.per_host_qps)
+        return limiter.reserve()
 
 
 class ScraperCall(Call):
     """
     A call to any arbitrary URL.
+
+    max_size: optional limit on the bytes of a (decompressed) response;
+              ResponseTooLarge is raised as soon as a response passes it.
+
+    With a FileCache as cache, responses are streamed to disk a chunk at a
+    time as they're downloaded, and the parser gets them memory-mapped,
+    so even large files never need to fit in memory.
     """
     def __init__(self, operation=None, timeout=None, max_qps=None,
                  parser=None, cache_reader=None, cache_writer=None,
-                 error_handler=None, max_retries=5, last_query_time=None):
+                 error_handler=None, max_retries=5, last_query_time=None,
+                 rate_limiter=None, transport=None, cache=None,
+                 single_flight=None, retry_policy=None, metrics=None,
+                 parsed_cache=None, stale_while_revalidate=None,
+                 negative_ttl=None, deadline=None, max_size=None):
         super(ScraperCall, self).__init__(operation, timeout, max_qps, parser,
                                           cache_reader, cache_writer,
-                                          error_handler, max_retries, last_query_time)
+                                          error_handler, max_retries,
+                                          last_query_time, rate_limiter,
+                                          transport, cache, single_flight,
+                                          retry_policy, metrics, parsed_cache,
+                                          stale_while_revalidate, negative_ttl,
+                                          deadline)
+        self.max_size = max_size
 
-    def __getattr__(self, k):
-        try:
-            return super(ScraperCall, self).__getattr__(self, k)
-        except:
-            return ScraperCall(operation=k, timeout=self.timeout,
-                               max_qps=self.max_qps, parser=self.parser,
-                               cache_reader=self.cache_reader,
-                               cache_writer=self.cache_writer,
-                               error_handler=self.error_handler,
-                               max_retries=self.max_retries,
-                               last_query_time=self._last_query_time)
-
-    def api_url(self, **kwargs):
-        """The URL for making the given query against the API."""
+    def _api_url(self, operation, kwargs):
         return kwargs.get('url')
 
-    def cache_url(self, **kwargs):
-        """A simplified URL to be used for caching the given query."""
-        return self.api_url(**kwargs)
+    def _cache_url(self, operation, kwargs):
+        return self._api_url(operation, kwargs)
+
+    def _streams(self):
+        """Whether responses are streamed into the cache, i.e. a FileCache."""
+        return self._keeps_entries() and hasattr(self.cache, 'set_stream')
+
+    def _body_chunks(self, response):
+        """
+        Yield response's decompressed body a chunk at a time, checking
+        it against max_size and the call's deadline as it goes.
+        """
+        try:
+            content_length = response.info().get('Content-Length')
+            if (self.max_size is not None and content_length and
+                    content_length.isdigit() and
+                    not response.info().get('Content-Encoding') and
+                    int(content_length) > self.max_size):
+                raise ResponseTooLarge(response.geturl(), self.max_size)
+
+            body = decoded_stream(response)
+            size = 0
+            while True:
+                left = time_left()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded("Deadline passed reading the response")
+                chunk = body.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    return
+                size += len(chunk)
+                if self.max_size is not None and size > self.max_size:
+                    raise ResponseTooLarge(response.geturl(), self.max_size)
+                yield chunk
+        finally:
+            response.close()
+
+    def _download(self, operation, response, store):
+        """
+        Pass the chunks of response's body to store, returning what it
+        does: the body, in one form or another.
+        """
+        if not self.metrics:
+            return store(self._body_chunks(response))
+
+        start = time.perf_counter()
+        body = store(self._body_chunks(response))
+        self.metrics.observe(operation, 'download', time.perf_counter() - start)
+        self.metrics.increment(operation, 'bytes_decoded', len(body))
+        return body
+
+    def _decode(self, operation, response):
+        if self.max_size is None:
+            return super(ScraperCall, self)._decode(operation, response)
+        # decompressed as it's read, so a response (or a gzip bomb) that
+        # turns out too big is caught before it's all in memory
+        return self._download(operation, response, b''.join)
+
+    def _store(self, operation, cache_url, response, stale_entry):
+        if not self._streams() or response.getcode() == 304:
+            return super(ScraperCall, self)._store(
+                operation, cache_url, response, stale_entry)
+
+        headers = response.info()
+        return self._download(operation, response, functools.partial(
+            self.cache.set_stream, cache_url, etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified')))
+
+    def crawl(self, urls, workers=8, per_host=2, per_host_qps=None):
+        """
+        Fetch many URLs at once, yielding a CrawlResult for each as soon as
+        it completes, so in no particular order. URLs are read from urls
+        lazily, and a failed URL doesn't stop the crawl; its CrawlResult
+        carries the exception instead.
+
+        Calls go through the cache, parser, retries and rate_limiter as
+        usual, and additionally each host gets its own limits, so one
+        busy host can't take over the crawl or be overwhelmed by it.
+
+        workers: the most URLs fetched at once.
+        per_host: the most URLs fetched at once from any one host.
+        per_host_qps: optional queries per second allowed per host.
+        """
+        scheduler = CrawlScheduler(urls, per_host, per_host_qps)
+        executor = ThreadPoolExecutor(workers)
+        running = set()
+        try:
+            while True:
+                while len(running) < workers:
+                    url = scheduler.next_url()
+                    if url is None:
+                        break
+                    running.add(executor.submit(
+                        contextvars.copy_context().run, self._crawl_url, url,
+                        scheduler.wait_time(url)))
+                if not running:
+                    return
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    scheduler.done(result.url)
+                    yield result
+        finally:
+            for future in running:
+                future.cancel()
+            executor.shutdown()
+
+    def _crawl_url(self, url, wait_time):
+        if wait_time > 0:
+            time.sleep(wait_time)
+        try:
+            return CrawlResult(url, self._invoke(CRAWL_OPERATION, {'url': url}), None)
+        except Exception as e:
+            return CrawlResult(url, None, e)
 
 
 class Scraper(ScraperCall):
     def __init__(self, operation=None, timeout=None, max_qps=None, parser=None,
                  cache_reader=None, cache_writer=None, error_handler=None,
-                 max_retries=5):
+                 max_retries=5, rate_limiter=None, transport=None,
+                 cache=None, single_flight=None, retry_policy=None,
+                 metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None, max_size=None):
         """
         Create a Scraper object.
         """
         ScraperCall.__init__(self, operation=operation,
                              timeout=timeout, max_qps=max_qps, parser=parser,
                              cache_reader=cache_reader, cache_writer=cache_writer,
-                             error_handler=error_handler, max_retries=max_retries)
+                             error_handler=error_handler, max_retries=max_retries,
+                             rate_limiter=rate_limiter, transport=transport,
+                             cache=cache, single_flight=single_flight,
+                             retry_policy=retry_policy, metrics=metrics,
+                             parsed_cache=parsed_cache,
+                             stale_while_revalidate=stale_while_revalidate,
+                             negative_ttl=negative_ttl, deadline=deadline,
+                             max_size=max_size)
+
+
+class AsyncScraperCall(AsyncCall, ScraperCall):
+    """
+    An awaitable call to any arbitrary URL. Responses are read into memory
+    whole before they're checked against max_size or cached.
+    """
+    def _decode(self, operation, response):
+        if self.max_size is None:
+            return AsyncCall._decode(self, operation, response)
+        return self._download(operation, response, b''.join)
+
+    async def crawl(self, urls, workers=8, per_host=2, per_host_qps=None):
+        """
+        Fetch many URLs at once as tasks, asynchronously yielding a
+        CrawlResult for each as soon as it completes. See Scraper.crawl().
+        """
+        scheduler = CrawlScheduler(urls, per_host, per_host_qps)
+        running = set()
+        try:
+            while True:
+                while len(running) < workers:
+                    url = scheduler.next_url()
+                    if url is None:
+                        break
+                    running.add(asyncio.ensure_future(
+                        self._crawl_url(url, scheduler.wait_time(url))))
+                if not running:
+                    return
+
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    scheduler.done(result.url)
+                    yield result
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def _crawl_url(self, url, wait_time):
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        try:
+            return CrawlResult(url, await self._invoke(CRAWL_OPERATION, {'url': url}),
+                               None)
+        except Exception as e:
+            return CrawlResult(url, None, e)
+
+
+class AsyncScraper(AsyncScraperCall):
+    def __init__(self, operation=None, timeout=None, max_qps=None, parser=None,
+                 cache_reader=None, cache_writer=None, error_handler=None,
+                 max_retries=5, rate_limiter=None, transport=None,
+                 cache=None, single_flight=None, retry_policy=None,
+                 metrics=None, parsed_cache=None,
+                 stale_while_revalidate=None, negative_ttl=None,
+                 deadline=None, max_size=None):
+        """
+        Create an awaitable Scraper object.
+        """
+        AsyncScraperCall.__init__(self, operation=operation,
+                                  timeout=timeout, max_qps=max_qps, parser=parser,
+                                  cache_reader=cache_reader, cache_writer=cache_writer,
+                                  error_handler=error_handler, max_retries=max_retries,
+                                  rate_limiter=rate_limiter, transport=transport,
+                                  cache=cache, single_flight=single_flight,
+                                  retry_policy=retry_policy, metrics=metrics,
+                                  parsed_cache=parsed_cache,
+                                  stale_while_revalidate=stale_while_revalidate,
+                                  negative_ttl=negative_ttl, deadline=deadline,
+                                  max_size=max_size)
 
-__all__ = ["Scraper"]
+__all__ = ["Scraper", "AsyncScraper", "CrawlResult", "CrawlScheduler",
+           "ResponseTooLarge"]
@@ -0,0 +1,57 @@
+import gzip
+
+from xml.etree import ElementTree
+
+
+def decoded_stream(response):
+    """
+    A file-like view of a urlopen()-style response's body that is
+    decompressed as it is read, rather than all at once.
+    """
+    content_encoding = response.info().get("Content-Encoding")
+    if content_encoding and "gzip" in content_encoding:
+        return gzip.GzipFile(fileobj=response, mode='rb')
+    return response
+
+
+def _local_name(tag):
+    # drop the {namespace} ElementTree prefixes tags with
+    return tag.rsplit('}', 1)[-1]
+
+
+def iterparse_elements(source, tags):
+    """
+    Incrementally parse the XML in source (a file-like object), yielding
+    each element whose tag is in tags, namespace aside, as soon as its
+    closing tag has been read.
+
+    Only outermost matches are yielded; an <Item> nested inside another
+    <Item> comes with its parent. Each yielded element is detached from
+    the tree once the caller moves on, so memory use is bounded by the
+    largest element rather than the whole document.
+    """
+    tags = set(tags)
+    parents = []
+    matching = 0
+
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        matches = _local_name(element.tag) in tags
+        if event == 'start':
+            parents.append(element)
+            if matches:
+                matching += 1
+            continue
+
+        parents.pop()
+        if not matches:
+            continue
+
+        matching -= 1
+        if matching == 0:
+            yield element
+            if parents:
+                parents[-1].remove(element)
+            element.clear()
+
+
+__all__ = ["decoded_stream", "iterparse_elements"]
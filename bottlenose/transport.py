@@ -0,0 +1,229 @@
+import io
+import logging
+import threading
+import time
+
+from http import client
+from urllib import parse, request
+from urllib.error import HTTPError, URLError
+
+
+log = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# errors meaning a kept-alive connection was closed by the server while idle
+STALE_CONNECTION_ERRORS = (client.RemoteDisconnected, client.BadStatusLine,
+                           BrokenPipeError, ConnectionResetError)
+
+
+class UrllibTransport(object):
+    """
+    Opens a fresh connection for every request with request.urlopen().
+    Honors the proxy settings in the environment.
+    """
+    def open(self, url, headers, timeout=None):
+        api_request = request.Request(url, headers=headers)
+        try:
+            return request.urlopen(api_request, timeout=timeout)
+        except HTTPError as e:
+            # the answer to a conditional request, not an error; the
+            # other transports return it too
+            if e.code == 304:
+                return e
+            raise
+
+    def close(self):
+        pass
+
+
+class PooledResponse(object):
+    """
+    A response from PooledTransport, shaped like the object urlopen()
+    returns. The connection goes back to the pool once the body has been
+    read to the end.
+    """
+    def __init__(self, transport, key, connection, response, url):
+        self._transport = transport
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._connection is not None and not self._response.isclosed():
+            # the body wasn't read, so the connection can't be reused
+            self._connection.close()
+            self._connection = None
+        self._release()
+
+    def _release(self):
+        if self._connection is not None:
+            if self._response.will_close:
+                self._connection.close()
+            else:
+                self._transport._checkin(self._key, self._connection)
+            self._connection = None
+
+
+class PooledTransport(object):
+    """
+    Keeps connections open between requests, so repeated calls to the same
+    host skip the TCP and TLS handshakes.
+
+    pool_size: maximum number of idle connections kept per host.
+    idle_timeout: seconds an idle connection is kept before being closed.
+    ssl_context: optional ssl.SSLContext for HTTPS connections.
+
+    Requests that would go through a proxy configured in the environment
+    are handed to UrllibTransport instead.
+    """
+    def __init__(self, pool_size=10, idle_timeout=60, ssl_context=None):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+
+        self._fallback = UrllibTransport()
+        self._proxies = request.getproxies()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # connections stay open in this process only
+        state = self.__dict__.copy()
+        del state['_idle'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key):
+        """Return an idle connection to key, or None. Thread-safe."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection
+                connection.close()
+        return None
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            return client.HTTPSConnection(host, port, timeout=timeout,
+                                          context=self.ssl_context)
+        return client.HTTPConnection(host, port, timeout=timeout)
+
+    def _uses_proxy(self, parts):
+        return (parts.scheme in self._proxies and
+                not request.proxy_bypass(parts.hostname))
+
+    def _request(self, url, headers, timeout):
+        parts = parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise URLError('unknown url type: %s' % parts.scheme)
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection = self._checkout(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self._connect(key, timeout)
+            else:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS as e:
+                connection.close()
+                if not reused:
+                    raise URLError(e)
+                # the server dropped an idle connection; retry on a new one
+                log.debug("Reconnecting to %s" % parts.netloc)
+                connection, reused = None, False
+                continue
+            except (OSError, client.HTTPException) as e:
+                # e.g. a malformed response; surfaced as URLError, like
+                # every other failure to get a response
+                connection.close()
+                raise URLError(e)
+
+            return PooledResponse(self, key, connection, response, url)
+
+    def open(self, url, headers, timeout=None):
+        """
+        GET url, following redirects. Like urlopen(), raises HTTPError for
+        error statuses and URLError when the host can't be reached.
+        """
+        parts = parse.urlsplit(url)
+        if self._uses_proxy(parts):
+            return self._fallback.open(url, headers, timeout)
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers, timeout)
+
+            location = response.headers.get('Location')
+            if response.status in REDIRECT_CODES and location:
+                response.read()
+                url = parse.urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                body = response.read()
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, io.BytesIO(body))
+
+            return response
+
+        response.read()
+        raise HTTPError(url, response.status, "Too many redirects",
+                        response.headers, io.BytesIO())
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+
+__all__ = ["PooledResponse", "PooledTransport", "UrllibTransport"]
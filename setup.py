@@ -51,4 +51,7 @@ setup(
     data_files=[("", ["LICENSE", "README.md"])],
     license=metadata['__license__'],
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': ['bottlenose = bottlenose.cli:main'],
+    },
 )
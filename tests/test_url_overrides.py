@@ -0,0 +1,52 @@
+import unittest
+
+from bottlenose import Call
+from bottlenose.amazon import Amazon
+from bottlenose.goodreads import Goodreads
+
+
+class LowerCaseAmazon(Amazon):
+    def cache_url(self, **kwargs):
+        return super(LowerCaseAmazon, self).cache_url(**kwargs).lower()
+
+
+class TaggedGoodreads(Goodreads):
+    def api_url(self, **kwargs):
+        return super(TaggedGoodreads, self).api_url(**kwargs) + "&tag=1"
+
+
+class LegacyCall(Call):
+    def api_url(self, **kwargs):
+        return "https://example.com/%s?q=%s" % (self.operation, kwargs['q'])
+
+    def cache_url(self, **kwargs):
+        return self.api_url(**kwargs)
+
+
+class UrlOverrideTest(unittest.TestCase):
+    def test_override_calling_super(self):
+        amazon = LowerCaseAmazon('key', 'secret', 'tag')
+        url = amazon.ItemLookup.cache_url(ItemId='ABC')
+        self.assertEqual(url, url.lower())
+        self.assertIn('itemid=abc', url)
+        self.assertEqual(amazon._cache_url('ItemLookup', {'ItemId': 'ABC'}), url)
+
+    def test_api_url_override_calling_super(self):
+        goodreads = TaggedGoodreads('key')
+        url = goodreads._api_url('search', {'q': 'x'})
+        self.assertTrue(url.endswith('&tag=1'))
+        self.assertIn('/search/', url)
+
+    def test_legacy_override(self):
+        call = LegacyCall()
+        self.assertEqual(call._api_url('Foo', {'q': 1}),
+                         "https://example.com/Foo?q=1")
+        self.assertEqual(call.Foo.cache_url(q=2), "https://example.com/Foo?q=2")
+
+    def test_no_override(self):
+        with self.assertRaises(NotImplementedError):
+            Call().api_url(q=1)
+
+
+if __name__ == '__main__':
+    unittest.main()